@@ -0,0 +1,245 @@
+"""
+Load test and latency benchmark for ChatConsumer.
+
+Boots ``websocket_tut.asgi.application`` in-process with an in-memory channel
+layer and a throwaway SQLite database (see benchmarks/settings.py), opens
+``--clients`` WebSocket clients spread over ``--rooms`` rooms through
+channels' WebsocketCommunicator and has every client send ``--rate`` messages
+per second for ``--duration`` seconds.
+
+Reports connect latency, history load time, end-to-end fan-out latency
+percentiles and delivered messages per second, and writes them as JSON to
+``--output`` so runs can be compared between releases. Runs entirely
+locally, no Redis.
+
+    python benchmarks/chat_load.py --clients 200 --rooms 10 --rate 2 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import transaction  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from core.counters import assign_sequences  # noqa: E402
+from core.models import Message, Room, User  # noqa: E402
+from websocket_tut.asgi import application  # noqa: E402
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list, in the list's unit"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values_ms):
+    return {
+        'count': len(values_ms),
+        'mean': sum(values_ms) / len(values_ms) if values_ms else None,
+        'p50': percentile(values_ms, 50),
+        'p95': percentile(values_ms, 95),
+        'p99': percentile(values_ms, 99),
+        'max': max(values_ms) if values_ms else None,
+    }
+
+
+def setup_database(clients, rooms, history):
+    """Create a fresh schema with users, rooms and seeded history"""
+    db_path = Path(settings.DATABASES['default']['NAME'])
+    # A stale WAL left next to a new database file would be replayed into it
+    for path in (db_path, db_path.with_name(db_path.name + '-wal'), db_path.with_name(db_path.name + '-shm')):
+        if path.exists():
+            path.unlink()
+    call_command('migrate', verbosity=0)
+
+    users = []
+    for i in range(clients):
+        user = User(username=f'bench{i}', email=f'bench{i}@example.com')
+        user.set_unusable_password()
+        users.append(user)
+    users = User.objects.bulk_create(users)
+
+    room_objs = Room.objects.bulk_create(
+        [Room(name=f'bench-room-{r}', creator=users[r % len(users)], is_group=True) for r in range(rooms)]
+    )
+    memberships = []
+    assignment = []
+    for i, user in enumerate(users):
+        room = room_objs[i % rooms]
+        memberships.append(Room.current_users.through(room_id=room.pk, user_id=user.pk))
+        assignment.append((user, room))
+    Room.current_users.through.objects.bulk_create(memberships)
+
+    seeded = []
+    for room in room_objs:
+        members = [user for user, r in assignment if r.pk == room.pk]
+        for n in range(history):
+            seeded.append(Message(room=room, user=members[n % len(members)], text=f'history {n}'))
+    with transaction.atomic():
+        assign_sequences(seeded)
+        Message.objects.bulk_create(seeded, batch_size=1000)
+
+    return [(user, room.pk, str(AccessToken.for_user(user))) for user, room in assignment]
+
+
+class BenchClient:
+    def __init__(self, index, user, room_id, token):
+        self.index = index
+        self.user = user
+        self.room_id = room_id
+        self.communicator = WebsocketCommunicator(
+            application, f'/ws/chat/{room_id}/?token={token}'
+        )
+        self.connect_ms = None
+        self.history_ms = None
+        self.latencies_ms = []
+        self.received = 0
+        self.sent = 0
+
+    async def connect(self):
+        start = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'client {self.index} was rejected')
+        self.connect_ms = (time.perf_counter() - start) * 1000
+
+        frame = await self.communicator.receive_json_from(timeout=30)
+        if frame.get('type') != 'message_history':
+            raise RuntimeError(f'client {self.index} expected message_history, got {frame.get("type")}')
+        self.history_ms = (time.perf_counter() - start) * 1000
+
+    async def send_loop(self, rate, duration):
+        interval = 1 / rate
+        deadline = time.perf_counter() + duration
+        next_send = time.perf_counter()
+        while next_send < deadline:
+            await self.communicator.send_json_to({
+                'type': 'chat_message',
+                'message': f'bench {self.index} {time.perf_counter()!r}',
+            })
+            self.sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+    async def receive_loop(self, expected, timeout):
+        while self.received < expected:
+            try:
+                frame = await self.communicator.receive_json_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+            if frame.get('type') != 'chat_message':
+                continue
+            text = frame['message']['text']
+            if text.startswith('bench '):
+                sent_at = float(text.rsplit(' ', 1)[1])
+                self.latencies_ms.append((time.perf_counter() - sent_at) * 1000)
+            self.received += 1
+
+
+async def run(args, accounts):
+    clients = [BenchClient(i, *account) for i, account in enumerate(accounts)]
+
+    # Connect in batches so the handshake numbers reflect a reconnect storm
+    # of --connect-concurrency clients rather than the whole fleet at once
+    connect_start = time.perf_counter()
+    for i in range(0, len(clients), args.connect_concurrency):
+        await asyncio.gather(*(c.connect() for c in clients[i:i + args.connect_concurrency]))
+    connect_elapsed = time.perf_counter() - connect_start
+
+    room_sizes = {}
+    for client in clients:
+        room_sizes[client.room_id] = room_sizes.get(client.room_id, 0) + 1
+    sends_per_client = math.ceil(args.duration * args.rate)
+
+    load_start = time.perf_counter()
+    receivers = [
+        asyncio.ensure_future(c.receive_loop(room_sizes[c.room_id] * sends_per_client, args.drain_timeout))
+        for c in clients
+    ]
+    await asyncio.gather(*(c.send_loop(args.rate, args.duration) for c in clients))
+    await asyncio.gather(*receivers)
+    load_elapsed = time.perf_counter() - load_start
+
+    for client in clients:
+        try:
+            await client.communicator.disconnect()
+        except (Exception, asyncio.CancelledError):
+            # A receive timeout already cancelled this client's application
+            pass
+
+    latencies = [ms for c in clients for ms in c.latencies_ms]
+    delivered = sum(c.received for c in clients)
+    sent = sum(c.sent for c in clients)
+    expected = sum(room_sizes[c.room_id] * c.sent for c in clients)
+    return {
+        'connect_ms': summarize([c.connect_ms for c in clients]),
+        'history_load_ms': summarize([c.history_ms for c in clients]),
+        'connect_total_s': connect_elapsed,
+        'fanout_latency_ms': summarize(latencies),
+        'messages_sent': sent,
+        'messages_delivered': delivered,
+        'messages_expected': expected,
+        'sent_per_second': sent / load_elapsed,
+        'delivered_per_second': delivered / load_elapsed,
+        'load_elapsed_s': load_elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ChatConsumer load test')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=1.0, help='messages per second per client')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of sending')
+    parser.add_argument('--history', type=int, default=200, help='seeded messages per room')
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--drain-timeout', type=float, default=10.0,
+                        help='seconds a client waits for a missing frame before giving up')
+    parser.add_argument('--output', default='bench_chat_load.json')
+    args = parser.parse_args()
+
+    accounts = setup_database(args.clients, args.rooms, args.history)
+    results = asyncio.run(run(args, accounts))
+    report = {
+        'benchmark': 'chat_load',
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'parameters': vars(args),
+        'results': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name in ('connect_ms', 'history_load_ms', 'fanout_latency_ms'):
+        stats = results[name]
+        print(f"{name:<18} p50={stats['p50']:.2f} p95={stats['p95']:.2f} p99={stats['p99']:.2f} max={stats['max']:.2f}"
+              if stats['count'] else f"{name:<18} no samples")
+    print(f"sent/s={results['sent_per_second']:.0f} delivered/s={results['delivered_per_second']:.0f} "
+          f"delivered={results['messages_delivered']}/{results['messages_expected']}")
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
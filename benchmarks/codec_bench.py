@@ -0,0 +1,89 @@
+"""
+Compare JSON text frames with msgpack binary frames.
+
+Builds frames shaped like ChatConsumer output (a single ``chat_message`` and
+a ``message_history`` page) and measures encoded size plus encode/decode
+throughput for both codecs. Needs only ``msgpack``; Django is not loaded.
+
+    python benchmarks/codec_bench.py --history 50 --iterations 2000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import msgpack
+
+
+def fake_message(pk, room_id=1, users=8):
+    created_at = datetime(2025, 7, 5, tzinfo=timezone.utc) + timedelta(seconds=pk)
+    user_id = pk % users + 1
+    return {
+        'id': pk,
+        'created_at_formatted': created_at.strftime("%d-%m-%Y %H:%M:%S"),
+        'user': {
+            'id': user_id,
+            'email': f'user{user_id}@example.com',
+            'username': f'user{user_id}',
+        },
+        'text': f'message number {pk} with a bit of ordinary chat text in it',
+        'created_at': created_at.isoformat().replace('+00:00', 'Z'),
+        'room': room_id,
+    }
+
+
+def frames(history):
+    return {
+        'chat_message': {
+            'type': 'chat_message',
+            'message': fake_message(history + 1),
+        },
+        'message_history': {
+            'type': 'message_history',
+            'messages': [fake_message(pk) for pk in range(1, history + 1)],
+            'has_more': True,
+            'next_before': None,
+        },
+    }
+
+
+CODECS = {
+    'json': (
+        lambda payload: json.dumps(payload).encode(),
+        lambda data: json.loads(data),
+    ),
+    'msgpack': (
+        lambda payload: msgpack.packb(payload, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    ),
+}
+
+
+def measure(payload, encode, decode, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        data = encode(payload)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(data)
+    decode_time = time.perf_counter() - start
+    return len(data), iterations / encode_time, iterations / decode_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--history', type=int, default=50, help='messages per message_history frame')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'frame':<16} {'codec':<8} {'bytes':>8} {'encode/s':>12} {'decode/s':>12}")
+    for name, payload in frames(args.history).items():
+        for codec, (encode, decode) in CODECS.items():
+            size, encode_rate, decode_rate = measure(payload, encode, decode, args.iterations)
+            print(f"{name:<16} {codec:<8} {size:>8} {encode_rate:>12.0f} {decode_rate:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Per-message cost of the ChatConsumer send path, without contention.
+
+One client sends ``--messages`` chat messages one at a time, each after the
+previous one came back through the room group, so the numbers isolate the
+server work per message (thread hops, queries, serialization, fan-out)
+from queueing. Also reports the sync_to_async thread hops made per message
+and per connection.
+
+    python benchmarks/message_roundtrip.py --messages 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from asgiref.sync import SyncToAsync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+
+from benchmarks.chat_load import setup_database, summarize  # noqa: E402
+from websocket_tut.asgi import application  # noqa: E402
+
+hops = 0
+_sync_to_async_call = SyncToAsync.__call__
+
+
+async def _counting_call(self, *args, **kwargs):
+    global hops
+    hops += 1
+    return await _sync_to_async_call(self, *args, **kwargs)
+
+
+SyncToAsync.__call__ = _counting_call
+
+
+async def run(args, account):
+    _, room_id, token = account
+    communicator = WebsocketCommunicator(application, f'/ws/chat/{room_id}/?token={token}')
+
+    before = hops
+    start = time.perf_counter()
+    connected, _ = await communicator.connect(timeout=30)
+    assert connected, 'connection rejected'
+    while (await communicator.receive_json_from(timeout=30)).get('type') != 'message_history':
+        pass
+    connect_ms = (time.perf_counter() - start) * 1000
+    connect_hops = hops - before
+
+    latencies = []
+    before = hops
+    for n in range(args.messages):
+        start = time.perf_counter()
+        await communicator.send_json_to({'type': 'chat_message', 'message': f'roundtrip {n}'})
+        while True:
+            frame = await communicator.receive_json_from(timeout=30)
+            if frame.get('type') == 'error':
+                raise RuntimeError(frame['message'])
+            if frame.get('type') == 'chat_message':
+                break
+        latencies.append((time.perf_counter() - start) * 1000)
+    message_hops = (hops - before) / args.messages
+
+    await communicator.disconnect()
+    return {
+        'connect_ms': connect_ms,
+        'connect_thread_hops': connect_hops,
+        'roundtrip_ms': summarize(latencies),
+        'thread_hops_per_message': message_hops,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ChatConsumer per-message round trip')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--history', type=int, default=200, help='seeded messages in the room')
+    parser.add_argument('--output', default='bench_message_roundtrip.json')
+    args = parser.parse_args()
+
+    accounts = setup_database(1, 1, args.history)
+    results = asyncio.run(run(args, accounts[0]))
+    report = {
+        'benchmark': 'message_roundtrip',
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'parameters': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    stats = results['roundtrip_ms']
+    print(f"roundtrip_ms p50={stats['p50']:.3f} p95={stats['p95']:.3f} p99={stats['p99']:.3f} mean={stats['mean']:.3f}")
+    print(f"thread hops: {results['thread_hops_per_message']:.2f} per message, "
+          f"{results['connect_thread_hops']} per connection (connect {results['connect_ms']:.1f} ms)")
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Settings for the local benchmarks: the project settings with an in-process
+channel layer and a throwaway SQLite database, so no Redis is needed.
+"""
+import os
+import tempfile
+
+from websocket_tut.settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        **DATABASES['default'],  # noqa: F405
+        'NAME': os.environ.get(
+            'BENCH_DB', os.path.join(tempfile.gettempdir(), 'websocket_tut_bench.sqlite3')
+        ),
+    }
+}
+
+# CHAT_CHANNEL_LAYER=local benchmarks core.layers.LocalChannelLayer instead
+# of the stock in-memory layer
+if CHAT_CHANNEL_LAYER != 'local':  # noqa: F405
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {
+                "capacity": 10000,
+            },
+        },
+    }
+
+# Benchmark clients send faster than the per-user limits allow
+CHAT_RATE_LIMITS = {}
+
+# and don't acknowledge what they receive
+CHAT_OUTBOUND_REQUIRE_ACKS = False
@@ -1,6 +1,8 @@
 from django.contrib import admin
-from .models import User, Room, Message
+from .models import User, Room, Message, RoomReadMarker, ArchivedMessage
 # Register your models here.
 admin.site.register(User)
 admin.site.register(Room)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(RoomReadMarker)
+admin.site.register(ArchivedMessage)
\ No newline at end of file
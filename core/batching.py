@@ -0,0 +1,99 @@
+"""
+Coalescing of chat_message frames for connections that opt in (``?batch=1``).
+
+Instead of one WebSocket frame per message, a batching connection receives
+
+    {"type": "chat_messages", "messages": [<chat_message frame>, ...]}
+
+whose items are exactly the chat_message frames it replaces. The array is
+assembled from the pre-encoded frames of the group events, so nothing is
+re-encoded.
+
+The window adapts to the room's message rate, measured per connection as a
+moving average of the gap between messages. Below ``CHAT_BATCH_MIN_RATE``
+messages per second every message goes out immediately, so quiet rooms see
+no added latency. Above it, messages wait up to ``CHAT_BATCH_MIN_WINDOW``
+seconds, rising linearly to ``CHAT_BATCH_MAX_WINDOW`` at
+``CHAT_BATCH_FULL_RATE``. A batch also goes out as soon as it holds
+``CHAT_BATCH_MAX_MESSAGES`` messages.
+"""
+import asyncio
+from django.conf import settings
+from .codecs import msgpack
+
+BATCH_MIN_WINDOW = getattr(settings, 'CHAT_BATCH_MIN_WINDOW', 0.010)
+BATCH_MAX_WINDOW = getattr(settings, 'CHAT_BATCH_MAX_WINDOW', 0.025)
+BATCH_MIN_RATE = getattr(settings, 'CHAT_BATCH_MIN_RATE', 20)
+BATCH_FULL_RATE = getattr(settings, 'CHAT_BATCH_FULL_RATE', 200)
+BATCH_MAX_MESSAGES = getattr(settings, 'CHAT_BATCH_MAX_MESSAGES', 50)
+
+# Weight of the newest gap in the moving average
+GAP_SMOOTHING = 0.2
+
+_JSON_PREFIX = '{"type": "chat_messages", "messages": '
+
+
+def join_frames(frames, use_msgpack):
+    """Wrap pre-encoded chat_message frames into one chat_messages frame"""
+    if use_msgpack:
+        packer = msgpack.Packer(use_bin_type=True)
+        head = packer.pack_map_header(2) + packer.pack('type') + packer.pack('chat_messages')
+        head += packer.pack('messages') + packer.pack_array_header(len(frames))
+        return {'bytes': head + b''.join(frame['bytes'] for frame in frames)}
+    return {'text': _JSON_PREFIX + '[' + ', '.join(frame['text'] for frame in frames) + ']}'}
+
+
+class FrameBatcher:
+    """Buffers the chat_message frames of one connection"""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.frames = []
+        self.avg_gap = None
+        self.last_at = None
+        self._handle = None
+
+    def window(self):
+        """Seconds to hold a message at the current rate (0 to send now)"""
+        if not self.avg_gap:
+            return 0
+        rate = 1 / self.avg_gap
+        if rate < BATCH_MIN_RATE:
+            return 0
+        share = min(1, (rate - BATCH_MIN_RATE) / max(BATCH_FULL_RATE - BATCH_MIN_RATE, 1))
+        return BATCH_MIN_WINDOW + share * (BATCH_MAX_WINDOW - BATCH_MIN_WINDOW)
+
+    async def add(self, frame):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.last_at is not None:
+            gap = now - self.last_at
+            self.avg_gap = gap if self.avg_gap is None else (1 - GAP_SMOOTHING) * self.avg_gap + GAP_SMOOTHING * gap
+        self.last_at = now
+
+        self.frames.append(frame)
+        if len(self.frames) >= BATCH_MAX_MESSAGES:
+            await self.flush()
+        elif self._handle is None:
+            window = self.window()
+            if not window:
+                await self.flush()
+            else:
+                self._handle = loop.call_later(window, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        frames, self.frames = self.frames, []
+        if len(frames) == 1:
+            await self.consumer.send_encoded(frames[0])
+        elif frames:
+            use_msgpack = self.consumer.use_msgpack and all('bytes' in frame for frame in frames)
+            await self.consumer.send_encoded(join_frames(frames, use_msgpack))
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self.frames = []
@@ -0,0 +1,74 @@
+import asyncio
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import QuerySet
+from .codecs import encode_frame
+from .metrics import GROUP_SEND_SECONDS
+
+NOTIFY_BATCH_SIZE = getattr(settings, 'CHAT_NOTIFY_BATCH_SIZE', 500)
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def notify_membership_changed(room_id, added=(), removed=()):
+    """Tell every ChatConsumer in the room that its roster changed"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    with GROUP_SEND_SECONDS.time(event='membership_changed'):
+        async_to_sync(channel_layer.group_send)(
+            room_group_name(room_id),
+            {
+                'type': 'membership_changed',
+                'added': [int(pk) for pk in added],
+                'removed': [int(pk) for pk in removed],
+            }
+        )
+
+
+def notify_user(user_id, data):
+    """Send a notification frame to one user's NotificationConsumer"""
+    notify_users([user_id], data)
+
+
+def notify_users(users, data):
+    """
+    Send one notification to many users. ``users`` is an iterable of user
+    ids or a User queryset. Returns the number of users notified.
+    """
+    if isinstance(users, QuerySet):
+        users = users.values_list('pk', flat=True)
+    user_ids = list(users)
+    if not user_ids:
+        return 0
+    return async_to_sync(anotify_users)(user_ids, data)
+
+
+async def anotify_users(user_ids, data, batch_size=NOTIFY_BATCH_SIZE):
+    """
+    Async version of notify_users taking a list of ids. The frame is encoded
+    once and the group sends of each batch are issued concurrently, so the
+    Redis layer pipelines them over its connection pool instead of waiting
+    for one round trip per user.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return 0
+    event = {
+        'type': 'user_notification',
+        **encode_frame({'type': 'notification', 'data': data}),
+    }
+    with GROUP_SEND_SECONDS.time(event='user_notification'):
+        for start in range(0, len(user_ids), batch_size):
+            await asyncio.gather(*(
+                channel_layer.group_send(user_group_name(user_id), event)
+                for user_id in user_ids[start:start + batch_size]
+            ))
+    return len(user_ids)
@@ -0,0 +1,134 @@
+"""
+Frame encodings for the WebSocket consumers.
+
+JSON text frames are the default. Clients pick another encoding by offering
+one of these WebSocket subprotocols; the first one offered that the server
+supports wins:
+
+    ``msgpack``       binary msgpack frames in both directions
+    ``msgpack.zlib``  as ``msgpack``, and large outbound frames are zlib
+                      compressed. Every frame is a msgpack map, which never
+                      starts with 0x78, so a compressed frame is recognised by
+                      its zlib header byte.
+    ``json.zlib``     JSON text frames, except that large outbound frames are
+                      sent as binary zlib compressed JSON
+
+Group events carry every frame pre-encoded in both forms so each recipient
+only picks one; nothing is re-encoded per connection.
+"""
+import json
+import zlib
+from django.conf import settings
+from .metrics import WS_MESSAGES_SENT
+from .outbound import OutboundQueueMixin, RESYNC_FRAME
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack ships with channels_redis
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'msgpack'
+MSGPACK_ZLIB_SUBPROTOCOL = 'msgpack.zlib'
+JSON_ZLIB_SUBPROTOCOL = 'json.zlib'
+
+COMPRESSION_THRESHOLD = getattr(settings, 'CHAT_COMPRESSION_THRESHOLD', 16 * 1024)
+COMPRESSION_LEVEL = getattr(settings, 'CHAT_COMPRESSION_LEVEL', 6)
+
+
+def encode_frame(payload):
+    """Encode a frame once for every supported protocol"""
+    frame = {'text': json.dumps(payload)}
+    if msgpack is not None:
+        frame['bytes'] = msgpack.packb(payload, use_bin_type=True)
+    return frame
+
+
+def supported_subprotocols():
+    if msgpack is None:
+        return [JSON_ZLIB_SUBPROTOCOL]
+    return [MSGPACK_SUBPROTOCOL, MSGPACK_ZLIB_SUBPROTOCOL, JSON_ZLIB_SUBPROTOCOL]
+
+
+class FrameCodecMixin(OutboundQueueMixin):
+    """
+    Negotiates the frame encoding of a consumer and sends frames in it,
+    through the connection's bounded outbound queue
+    """
+
+    use_msgpack = False
+    use_compression = False
+    metrics_name = 'consumer'
+
+    def negotiate_subprotocol(self):
+        """Return the subprotocol to accept with, or None for plain JSON"""
+        supported = supported_subprotocols()
+        for subprotocol in self.scope.get('subprotocols') or []:
+            if subprotocol in supported:
+                self.use_msgpack = subprotocol.startswith(MSGPACK_SUBPROTOCOL)
+                self.use_compression = subprotocol.endswith('.zlib')
+                return subprotocol
+        return None
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """Decode an inbound frame; raises ValueError on malformed input"""
+        if bytes_data is not None:
+            if msgpack is None:
+                raise ValueError('Binary frames are not supported')
+            try:
+                payload = msgpack.unpackb(bytes_data, raw=False)
+            except Exception:
+                raise ValueError('Invalid msgpack frame')
+        else:
+            payload = json.loads(text_data)
+        if not isinstance(payload, dict):
+            raise ValueError('Frame must be an object')
+        return payload
+
+    async def send_frame(self, payload):
+        """Encode and send a frame for this connection only"""
+        if self.use_msgpack:
+            data = msgpack.packb(payload, use_bin_type=True)
+            if self.use_compression and len(data) > COMPRESSION_THRESHOLD:
+                data = zlib.compress(data, COMPRESSION_LEVEL)
+            await self.send(bytes_data=data)
+            return
+
+        text = json.dumps(payload)
+        if self.use_compression and len(text) > COMPRESSION_THRESHOLD:
+            await self.send(bytes_data=zlib.compress(text.encode(), COMPRESSION_LEVEL))
+        else:
+            await self.send(text_data=text)
+
+    async def send(self, text_data=None, bytes_data=None, close=False, ephemeral=False):
+        if text_data is not None or bytes_data is not None:
+            WS_MESSAGES_SENT.inc(consumer=self.metrics_name)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close, ephemeral=ephemeral)
+
+    async def send_encoded(self, frame, ephemeral=False):
+        """
+        Send a frame produced by encode_frame (e.g. from a group event).
+        Ephemeral frames are the first dropped when the client falls behind.
+        """
+        if self.use_msgpack and 'bytes' in frame:
+            await self.send(bytes_data=frame['bytes'], ephemeral=ephemeral)
+        else:
+            await self.send(text_data=frame['text'], ephemeral=ephemeral)
+
+    def outbound_marker(self):
+        if self.use_msgpack:
+            return {'type': 'websocket.send', 'bytes': msgpack.packb(RESYNC_FRAME, use_bin_type=True)}
+        return super().outbound_marker()
+
+
+def compact_history(messages):
+    """
+    Move the nested user of every message into a shared users table, so each
+    distinct user is sent once per page and messages refer to it by id.
+    """
+    users = {}
+    compacted = []
+    for message in messages:
+        user = message['user']
+        users.setdefault(user['id'], user)
+        compacted.append({**message, 'user': user['id']})
+    return list(users.values()), compacted
@@ -92,43 +92,102 @@
 
 # chat/consumers.py
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import AccessToken
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from .models import Room, Message
+from .counters import record_messages
 from .serializers import MessageSerializer
+from .pagination import clamp_limit, encode_data_cursor, InvalidCursor, SYNC_MAX_MESSAGES
+from .retention import room_history_rows, rows_after, rows_in_seq_range
+from .history_cache import history_cache
+from .broadcast import room_group_name
+from .db import db_read, db_write
+from .write_behind import write_behind, new_provisional_id, WRITE_BEHIND_ENABLED
+from .codecs import FrameCodecMixin, encode_frame, compact_history
+from .presence import presence_tracker
+from .ratelimit import rate_limiter
+from .batching import FrameBatcher
+from .ephemeral import ephemeral_coalescer, clean_ephemeral, EPHEMERAL_TYPES
+from .metrics import (
+    WS_CONNECTS, WS_REJECTS, WS_MESSAGES_RECEIVED, WS_ROOM_CONNECTIONS,
+    WS_USER_CONNECTIONS, DB_CALL_SECONDS, GROUP_SEND_SECONDS, timed
+)
 from asgiref.sync import sync_to_async
 
 User = get_user_model()
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Frame types ChatConsumer handles; anything else is counted as 'other'
+FRAME_TYPES = frozenset(['chat_message', 'get_messages', 'sync', 'replay', 'presence', 'ack', *EPHEMERAL_TYPES])
+
+class ChatConsumer(FrameCodecMixin, AsyncWebsocketConsumer):
+    metrics_name = 'chat'
+    
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_group_name = room_group_name(self.room_id)
         self.user = self.scope['user']
+        self.is_member = False
+        self.room_creator_id = None
+        self.joined_room = False
+        # ?compact=1 sends history with a shared users table
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        self.compact_history = query_params.get('compact', ['0'])[0] in ('1', 'true')
+        # ?batch=1 coalesces busy rooms' messages into chat_messages frames
+        batch = query_params.get('batch', ['0'])[0] in ('1', 'true')
+        self.frame_batcher = FrameBatcher(self) if batch else None
+        # Clients report delivery with ack frames, bounding their backlog
+        # under daphne (opt-in with ?ack=1 unless CHAT_OUTBOUND_REQUIRE_ACKS)
+        self.negotiate_outbound_acks()
+        # ?since=<message id> only sends what a reconnecting client missed;
+        # ?history=0 leaves the first page to a get_messages or sync frame
+        since = query_params.get('since', [''])[0]
+        # isdigit() alone accepts digits int() can't parse, like '²'
+        self.since = int(since) if since.isascii() and since.isdigit() else None
+        self.send_history = query_params.get('history', ['1'])[0] not in ('0', 'false')
         
         # Check if user is authenticated
         if self.user.is_anonymous:
+            WS_REJECTS.inc(consumer=self.metrics_name, reason='anonymous')
             await self.close()
             return
             
-        # Check if room exists and user has access
-        room_exists = await self.check_room_access()
-        if not room_exists:
-            await self.close()
-            return
-        
-        # Join room group
+        # Join room group before checking access, so a membership_changed
+        # event sent while the check runs still reaches this connection
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         
-        await self.accept()
+        # Check if room exists and user has access. Membership is resolved
+        # once here and kept up to date by membership_changed events.
+        self.is_member = await self.check_room_access()
+        if not self.is_member:
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+            WS_REJECTS.inc(consumer=self.metrics_name, reason='forbidden')
+            await self.close()
+            return
+        
+        history_cache.connected(self.room_id)
+        presence_tracker.connected(self.room_id, self.channel_name, self.user.id)
+        WS_ROOM_CONNECTIONS.inc(room=self.room_id)
+        self.joined_room = True
+        
+        await self.accept(subprotocol=self.negotiate_subprotocol())
+        WS_CONNECTS.inc(consumer=self.metrics_name)
         
         # Send existing messages to the newly connected user
-        await self.send_existing_messages()
+        if self.since is not None:
+            await self.send_messages_since(self.since)
+        elif self.send_history:
+            await self.send_existing_messages()
     
     async def disconnect(self, close_code):
         # Leave room group
@@ -136,20 +195,67 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if self.joined_room:
+            history_cache.disconnected(self.room_id)
+            presence_tracker.disconnected(self.room_id, self.channel_name)
+            ephemeral_coalescer.forget(self.room_id, self.user.id)
+            WS_ROOM_CONNECTIONS.dec(room=self.room_id)
+            self.joined_room = False
+        if self.frame_batcher is not None:
+            self.frame_batcher.cancel()
+        
+        # Don't let a closing connection leave its messages queued
+        if WRITE_BEHIND_ENABLED:
+            await write_behind.flush()
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type', 'chat_message')
+            payload = self.decode_frame(text_data, bytes_data)
+            message_type = payload.get('type', 'chat_message')
+            # Client-chosen types would grow the registry without bound
+            label = message_type if isinstance(message_type, str) and message_type in FRAME_TYPES else 'other'
+            WS_MESSAGES_RECEIVED.inc(consumer=self.metrics_name, type=label)
+            
+            if message_type == 'ack':
+                self.acknowledge_outbound(payload.get('received'))
+                return
+            
+            if not self.is_member:
+                await self.send_frame({
+                    'type': 'error',
+                    'message': 'You are no longer a member of this room'
+                })
+                return
+            
+            retry_after = rate_limiter.check(message_type, self.user.id, self.room_id)
+            if retry_after:
+                await self.send_frame({
+                    'type': 'error',
+                    'code': 'rate_limited',
+                    'message': 'Too many requests, slow down',
+                    'action': message_type,
+                    'retry_after': round(retry_after, 3)
+                })
+                return
             
             if message_type == 'chat_message':
-                message_text = text_data_json.get('message', '')
+                message_text = payload.get('message', '')
                 
-                if not message_text.strip():
-                    await self.send(text_data=json.dumps({
+                if not isinstance(message_text, str) or not message_text.strip():
+                    await self.send_frame({
                         'type': 'error',
                         'message': 'Message cannot be empty'
-                    }))
+                    })
+                    return
+                
+                if WRITE_BEHIND_ENABLED:
+                    # Broadcast now under a provisional id, persist in a batch
+                    message = self.build_message(message_text)
+                    message_data = self.serialize_message(message)
+                    message_data['id'] = message.provisional_id
+                    message_data['provisional'] = True
+                    await self.broadcast_message(message_data)
+                    await write_behind.enqueue(message)
                     return
                 
                 # Save message to database
@@ -157,110 +263,298 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 
                 if message:
                     # Serialize the message
-                    message_data = await self.serialize_message(message)
-                    
-                    # Send message to room group
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message_data': message_data
-                        }
-                    )
+                    message_data = self.serialize_message(message)
+                    await self.broadcast_message(message_data)
             
             elif message_type == 'get_messages':
-                # Send existing messages
-                await self.send_existing_messages()
+                # Send one page of history older than the given cursor
+                await self.send_existing_messages(
+                    before=payload.get('before'),
+                    limit=payload.get('limit'),
+                    compact=payload.get('compact')
+                )
+            
+            elif message_type == 'sync':
+                # Catch up from the last message id the client has seen
+                since = payload.get('since')
+                if not isinstance(since, int) or isinstance(since, bool) or since < 0:
+                    raise ValueError('since must be a message id')
+                await self.send_messages_since(since, compact=payload.get('compact'))
+            
+            elif message_type == 'replay':
+                # Fill a gap the client detected in the seq numbers
+                after_seq = payload.get('after_seq')
+                until_seq = payload.get('until_seq')
+                for value in (after_seq, until_seq):
+                    if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+                        raise ValueError('after_seq and until_seq must be sequence numbers')
+                if after_seq is None:
+                    raise ValueError('after_seq is required')
+                messages, has_more = await self.get_messages_in_seq_range(after_seq, until_seq)
+                await self.send_frame({
+                    'type': 'message_replay',
+                    'after_seq': after_seq,
+                    'until_seq': until_seq,
+                    'messages': messages,
+                    'has_more': has_more
+                })
+            
+            elif message_type in EPHEMERAL_TYPES:
+                # Typing and read hints: coalesced in memory, never stored
+                ephemeral_coalescer.submit(self.room_id, self.user, clean_ephemeral(payload))
+            
+            elif message_type == 'presence':
+                # Answered from the in-memory rosters, no database access
+                await self.send_frame({
+                    'type': 'presence',
+                    'online': presence_tracker.online(self.room_id)
+                })
                 
+        except InvalidCursor as e:
+            await self.send_frame({
+                'type': 'error',
+                'message': str(e)
+            })
         except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': 'Invalid JSON format'
-            }))
+            })
+        except ValueError as e:
+            await self.send_frame({
+                'type': 'error',
+                'message': str(e)
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': f'An error occurred: {str(e)}'
-            }))
+            })
+    
+    async def broadcast_message(self, message_data):
+        """Send a serialized message to the room group"""
+        # Encode the outbound frame once; every recipient
+        # forwards the same text instead of re-encoding it
+        event = {
+            'type': 'chat_message',
+            **encode_frame({
+                'type': 'chat_message',
+                'message': message_data
+            })
+        }
+        if history_cache.enabled:
+            # Receiving workers append the raw data to their history cache
+            event['message'] = message_data
+        with GROUP_SEND_SECONDS.time(event='chat_message'):
+            await self.channel_layer.group_send(self.room_group_name, event)
     
     async def chat_message(self, event):
-        message_data = event['message_data']
+        if 'message' in event:
+            history_cache.append(self.room_id, event['message'])
         
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': message_data
-        }))
+        # Send the pre-encoded frame to WebSocket
+        if self.frame_batcher is not None:
+            await self.frame_batcher.add(event)
+        else:
+            await self.send_encoded(event)
+    
+    async def message_persisted(self, event):
+        for message_data in event.get('message_data', []):
+            history_cache.append(self.room_id, message_data)
+        
+        # Map provisional ids of write-behind messages to their real ids,
+        # after the messages they refer to
+        if self.frame_batcher is not None:
+            await self.frame_batcher.flush()
+        await self.send_encoded(event)
+    
+    async def ephemeral_events(self, event):
+        await self.send_encoded(event, ephemeral=True)
+    
+    async def presence_state(self, event):
+        """Merge a worker's announced roster; forward the change if any"""
+        frame = presence_tracker.apply(self.room_id, event)
+        if frame is not None:
+            await self.send_encoded(frame, ephemeral=True)
+    
+    async def presence_diff(self, event):
+        # Users of an expired roster, sent by this worker's tracker
+        await self.send_encoded(event, ephemeral=True)
     
-    @database_sync_to_async
-    def check_room_access(self):
+    async def membership_changed(self, event):
+        """Apply a roster change pushed by the membership views"""
+        if self.user.id == self.room_creator_id:
+            return
+        if self.user.id in event.get('removed', []):
+            self.is_member = False
+            await self.close()
+        elif self.user.id in event.get('added', []):
+            self.is_member = True
+    
+    @timed(DB_CALL_SECONDS, call='check_room_access')
+    async def check_room_access(self):
         """Check if room exists and user has access to it"""
-        try:
-            room = Room.objects.get(pk=self.room_id)
-            
-            # Check if user is in the room or is the creator
-            return (self.user in room.current_users.all() or 
-                   room.creator == self.user)
-        except Room.DoesNotExist:
+        # One query: the creator id plus an EXISTS on the membership table
+        memberships = Room.current_users.through.objects.filter(
+            room_id=OuterRef('pk'), user_id=self.user.id
+        )
+        room = await (Room.objects.filter(pk=self.room_id)
+                      .annotate(is_current_user=Exists(memberships))
+                      .values('creator_id', 'is_current_user')
+                      .afirst())
+        if room is None:
             return False
+        
+        self.room_creator_id = room['creator_id']
+        # Check if user is in the room or is the creator
+        return room['is_current_user'] or room['creator_id'] == self.user.id
     
-    @database_sync_to_async
+    @timed(DB_CALL_SECONDS, call='save_message')
+    @db_write
     def save_message(self, message_text):
         """Save message to database"""
-        try:
-            room = Room.objects.get(pk=self.room_id)
-            
-            # Check if user has access to send messages in this room
-            if self.user not in room.current_users.all() and room.creator != self.user:
-                return None
-                
+        # Access was checked on connect and is revoked by membership_changed.
+        # The message is numbered from the room's counter in this transaction
+        with transaction.atomic():
             message = Message.objects.create(
-                room=room,
+                room_id=self.room_id,
                 user=self.user,
                 text=message_text
             )
-            return message
-        except Room.DoesNotExist:
-            return None
+            record_messages(self.room_id, [message])
+        return message
+    
+    def build_message(self, message_text):
+        """Build an unsaved message for the write-behind queue"""
+        message = Message(
+            room_id=self.room_id,
+            user=self.user,
+            text=message_text,
+            created_at=timezone.now()
+        )
+        message.provisional_id = new_provisional_id()
+        return message
     
-    @database_sync_to_async
     def serialize_message(self, message):
-        """Serialize message using MessageSerializer"""
+        """
+        Serialize message using MessageSerializer. Runs on the event loop:
+        the user is already loaded and the room is rendered from room_id, so
+        nothing here touches the database.
+        """
         serializer = MessageSerializer(message)
         return serializer.data
     
-    @database_sync_to_async
-    def get_room_messages(self):
-        """Get all messages for the room"""
-        try:
-            room = Room.objects.get(pk=self.room_id)
-            messages = Message.objects.filter(room=room).order_by('created_at')
-            serializer = MessageSerializer(messages, many=True)
-            return serializer.data
-        except Room.DoesNotExist:
-            return []
+    # History reads run their queries in one db_read call (they may read both
+    # the hot table and the archive) and serialize the rows on the loop
+    
+    @timed(DB_CALL_SECONDS, call='get_room_messages')
+    async def get_room_messages(self, before=None, limit=None):
+        """Get one page of room messages older than ``before``"""
+        # Falls back to the archive when the page reaches past the hot table
+        messages, has_more, next_before = await db_read(room_history_rows)(
+            self.room_id, before, clamp_limit(limit)
+        )
+        serializer = MessageSerializer(messages, many=True)
+        return serializer.data, has_more, next_before
     
-    async def send_existing_messages(self):
-        """Send existing messages to the user"""
-        messages = await self.get_room_messages()
-        await self.send(text_data=json.dumps({
+    @timed(DB_CALL_SECONDS, call='get_recent_messages')
+    async def get_recent_messages(self, count):
+        """Get the newest ``count`` messages to seed the history cache"""
+        messages, has_more, _ = await db_read(room_history_rows)(self.room_id, None, count)
+        return MessageSerializer(messages, many=True).data, has_more
+    
+    @timed(DB_CALL_SECONDS, call='get_messages_since')
+    async def get_messages_since(self, message_id):
+        """Messages newer than ``message_id``, or None if there are too many"""
+        messages = await db_read(rows_after)(self.room_id, message_id, SYNC_MAX_MESSAGES)
+        if messages is None:
+            return None
+        return MessageSerializer(messages, many=True).data
+    
+    @timed(DB_CALL_SECONDS, call='get_messages_in_seq_range')
+    async def get_messages_in_seq_range(self, after_seq, until_seq):
+        """At most REPLAY_MAX_MESSAGES messages with after_seq < seq <= until_seq"""
+        messages, has_more = await db_read(rows_in_seq_range)(self.room_id, after_seq, until_seq)
+        return MessageSerializer(messages, many=True).data, has_more
+    
+    async def get_cached_messages(self, limit):
+        """Serve the newest page from the history cache, seeding it on a miss"""
+        limit = clamp_limit(limit)
+        page = history_cache.page(self.room_id, limit)
+        if page is not None:
+            return page
+        
+        token = history_cache.prime_token(self.room_id)
+        messages, has_more = await self.get_recent_messages(max(limit, history_cache.size))
+        history_cache.prime(self.room_id, messages, has_more, token)
+        
+        page = messages[-limit:]
+        has_more = has_more or len(messages) > len(page)
+        next_before = encode_data_cursor(page[0]) if has_more and page else None
+        return page, has_more, next_before
+    
+    async def send_existing_messages(self, before=None, limit=None, compact=None):
+        """Send a page of existing messages to the user"""
+        if before is None and history_cache.enabled:
+            messages, has_more, next_before = await self.get_cached_messages(limit)
+        else:
+            messages, has_more, next_before = await self.get_room_messages(before, limit)
+        
+        frame = {
             'type': 'message_history',
+            'messages': messages,
+            'has_more': has_more,
+            'next_before': next_before
+        }
+        if compact is None:
+            compact = self.compact_history
+        if compact:
+            frame['users'], frame['messages'] = compact_history(messages)
+        # Large pages are compressed if the client negotiated a .zlib subprotocol
+        await self.send_frame(frame)
+    
+    async def send_messages_since(self, message_id, compact=None):
+        """Send only the messages newer than ``message_id``"""
+        messages = history_cache.since(self.room_id, message_id) if history_cache.enabled else None
+        if messages is None:
+            messages = await self.get_messages_since(message_id)
+        
+        if messages is None or len(messages) > SYNC_MAX_MESSAGES:
+            # Too far behind: start over from the newest page
+            await self.send_frame({
+                'type': 'resync_required',
+                'reason': 'too_far_behind'
+            })
+            await self.send_existing_messages(compact=compact)
+            return
+        
+        frame = {
+            'type': 'message_sync',
+            'since': message_id,
             'messages': messages
-        }))
+        }
+        if compact is None:
+            compact = self.compact_history
+        if compact:
+            frame['users'], frame['messages'] = compact_history(messages)
+        await self.send_frame(frame)
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(FrameCodecMixin, AsyncWebsocketConsumer):
     """Consumer for user-specific notifications"""
     
+    metrics_name = 'notification'
     
     async def connect(self):
         self.user = self.scope['user']
         
         if self.user.is_anonymous:
+            WS_REJECTS.inc(consumer=self.metrics_name, reason='anonymous')
             await self.close()
             return
             
         self.user_group_name = f'user_{self.user.id}'
+        self.negotiate_outbound_acks()
         
         # Join user group
         await self.channel_layer.group_add(
@@ -268,7 +562,9 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept(subprotocol=self.negotiate_subprotocol())
+        WS_CONNECTS.inc(consumer=self.metrics_name)
+        WS_USER_CONNECTIONS.inc()
     
     async def disconnect(self, close_code):
         # Leave user group
@@ -277,14 +573,24 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.user_group_name,
                 self.channel_name
             )
+            WS_USER_CONNECTIONS.dec()
     
-    async def receive(self, text_data):
-        # Handle incoming messages if needed
-        pass
+    async def receive(self, text_data=None, bytes_data=None):
+        # Clients only send delivery acks (see core/outbound.py)
+        try:
+            payload = self.decode_frame(text_data, bytes_data)
+        except ValueError:
+            return
+        if payload.get('type') == 'ack':
+            self.acknowledge_outbound(payload.get('received'))
     
     async def user_notification(self, event):
         """Send notification to user"""
-        await self.send(text_data=json.dumps({
-            'type': 'notification',
-            'data': event['data']
-        }))
\ No newline at end of file
+        if 'text' not in event:
+            # Senders that only pass raw data still work
+            await self.send_frame({
+                'type': 'notification',
+                'data': event['data']
+            })
+            return
+        await self.send_encoded(event)
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Maintenance of the denormalized Room columns (last_message, last_activity_at,
+message_count, member_count). Writers update them with F() expressions in
+the same transaction as the change they describe; ``rebuild_room_counters``
+recomputes them from scratch. ``message_count`` counts every message of the
+room, hot or archived, so archiving leaves it unchanged.
+"""
+from django.db.models import Count, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from .models import ArchivedMessage, Room, Message
+
+
+def record_messages(room_id, messages):
+    """Account for newly inserted messages of one room, oldest first"""
+    if not messages:
+        return
+    last = messages[-1]
+    Room.objects.filter(pk=room_id).update(
+        last_message_id=last.pk,
+        last_activity_at=last.created_at,
+        message_count=F('message_count') + len(messages),
+    )
+
+
+def assign_sequences(messages):
+    """
+    Give unsaved messages of any rooms consecutive per-room sequence numbers
+    ahead of a bulk_create, reserving them from each room's counter. Must run
+    in the transaction of the insert.
+    """
+    counts = {}
+    for message in messages:
+        counts[message.room_id] = counts.get(message.room_id, 0) + 1
+    next_seq = {room_id: Room.objects.reserve_seq(room_id, count) for room_id, count in counts.items()}
+    for message in messages:
+        message.seq = next_seq[message.room_id]
+        next_seq[message.room_id] += 1
+
+
+def adjust_member_count(room_id, delta):
+    if delta:
+        Room.objects.filter(pk=room_id).update(member_count=F('member_count') + delta)
+
+
+def rebuild_room_counters(rooms=None):
+    """Recompute every denormalized column of ``rooms`` (default: all rooms)"""
+    if rooms is None:
+        rooms = Room.objects.all()
+    members = (Room.current_users.through.objects
+               .filter(room_id=OuterRef('pk'))
+               .order_by().values('room_id')
+               .annotate(count=Count('pk')).values('count'))
+    messages = (Message.objects.filter(room_id=OuterRef('pk'))
+                .order_by().values('room_id')
+                .annotate(count=Count('pk')).values('count'))
+    archived = (ArchivedMessage.objects.filter(room_id=OuterRef('pk'))
+                .order_by().values('room_id')
+                .annotate(count=Count('pk')).values('count'))
+    latest = Message.objects.filter(room_id=OuterRef('pk')).order_by('-created_at', '-pk')
+    newest_seq = [
+        Coalesce(Subquery(model.objects.filter(room_id=OuterRef('pk'))
+                          .order_by().values('room_id').annotate(seq=Max('seq')).values('seq')), Value(0))
+        for model in (Message, ArchivedMessage)
+    ]
+    return rooms.update(
+        member_count=Coalesce(Subquery(members), Value(0)),
+        message_count=Coalesce(Subquery(messages), Value(0)) + Coalesce(Subquery(archived), Value(0)),
+        last_message_id=Subquery(latest.values('pk')[:1]),
+        last_activity_at=Subquery(latest.values('created_at')[:1]),
+        # Only ever raised: numbers of deleted messages must not come back
+        last_seq=Greatest(F('last_seq'), *newest_seq),
+    )
@@ -0,0 +1,95 @@
+"""
+Thread pools for ORM work and SQLite connection tuning.
+
+``database_sync_to_async`` runs every call on asgiref's single thread
+(thread_sensitive), so a history load waits behind whatever INSERT is in
+front of it. Consumers instead hand their database calls to one of two
+pools, used like database_sync_to_async:
+
+    db_read     history pages, sync and replay reads
+                (``CHAT_DB_READ_THREADS`` threads)
+    db_write    message inserts and write-behind batches
+                (``CHAT_DB_WRITE_THREADS`` threads; SQLite takes one writer
+                at a time, so more threads only queue on its lock)
+
+Each pool thread keeps its own connection. The time a call waits for a
+thread, and how many calls are waiting or running, are exported as metrics.
+The lookups made through the async ORM (room access, JWT user) still
+use asgiref's thread, which no longer runs any writes.
+
+Every new SQLite connection gets ``CHAT_SQLITE_PRAGMAS``. By default these
+switch to WAL, so readers no longer block on a writer. They also relax
+``synchronous`` to NORMAL, which is still safe in WAL mode. Finally they
+let writers wait up to ``busy_timeout`` ms for the lock instead of failing
+at once.
+"""
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from .metrics import DB_POOL_QUEUED, DB_POOL_ACTIVE, DB_POOL_WAIT_SECONDS
+
+DB_READ_THREADS = getattr(settings, 'CHAT_DB_READ_THREADS', 4)
+DB_WRITE_THREADS = getattr(settings, 'CHAT_DB_WRITE_THREADS', 1)
+SQLITE_PRAGMAS = getattr(settings, 'CHAT_SQLITE_PRAGMAS', {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+})
+
+
+class DatabasePool:
+    """A sized thread pool running sync ORM calls for async code"""
+
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f'db-{name}')
+        self._lock = threading.Lock()
+
+    def __call__(self, func):
+        """Wrap a sync function into a coroutine function run on this pool"""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            queued = [time.perf_counter()]
+            DB_POOL_QUEUED.inc(pool=self.name)
+
+            def run():
+                self._leave_queue(queued)
+                DB_POOL_ACTIVE.inc(pool=self.name)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    DB_POOL_ACTIVE.dec(pool=self.name)
+
+            try:
+                return await DatabaseSyncToAsync(run, thread_sensitive=False, executor=self.executor)()
+            finally:
+                # Cancelled before a thread picked it up
+                self._leave_queue(queued)
+        return wrapper
+
+    def _leave_queue(self, queued):
+        with self._lock:
+            if not queued:
+                return
+            queued_at = queued.pop()
+        DB_POOL_QUEUED.dec(pool=self.name)
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - queued_at, pool=self.name)
+
+
+db_read = DatabasePool('read', DB_READ_THREADS)
+db_write = DatabasePool('write', DB_WRITE_THREADS)
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not SQLITE_PRAGMAS:
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
@@ -0,0 +1,127 @@
+"""
+Ephemeral room events: typing indicators and read position hints.
+
+They are never stored or run through DRF. Each worker collects the events of
+a room for ``CHAT_EPHEMERAL_FLUSH_INTERVAL`` seconds and sends them as one
+``ephemeral_events`` group event, keeping only the latest state per user
+and kind (a ``typing`` followed by ``stop_typing`` in one window sends just
+the stop). On top of that:
+
+    * a ``typing`` repeated while the user is already announced as typing is
+      dropped until ``CHAT_TYPING_REFRESH`` seconds passed, so clients only
+      need a refresh to keep the indicator alive;
+    * each user may submit ``CHAT_EPHEMERAL_RATE`` events per second per
+      room; the rest are dropped silently, they are only hints.
+
+A room therefore gets at most one ephemeral group send per flush interval
+per worker, however fast its members type.
+"""
+import asyncio
+import logging
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .broadcast import room_group_name
+from .codecs import encode_frame
+
+logger = logging.getLogger(__name__)
+
+EPHEMERAL_FLUSH_INTERVAL = getattr(settings, 'CHAT_EPHEMERAL_FLUSH_INTERVAL', 0.25)
+EPHEMERAL_RATE = getattr(settings, 'CHAT_EPHEMERAL_RATE', 5)
+TYPING_REFRESH = getattr(settings, 'CHAT_TYPING_REFRESH', 3)
+
+# Event type -> the state it sets; later events of a kind replace earlier ones
+EPHEMERAL_TYPES = {
+    'typing': 'typing',
+    'stop_typing': 'typing',
+    'read_position': 'read_position',
+}
+
+
+def clean_ephemeral(payload):
+    """Validate an inbound ephemeral frame and keep only its known fields"""
+    event_type = payload['type']
+    if event_type == 'read_position':
+        message_id = payload.get('message_id')
+        if not isinstance(message_id, int) or isinstance(message_id, bool):
+            raise ValueError('message_id must be an integer')
+        return {'type': event_type, 'message_id': message_id}
+    return {'type': event_type}
+
+
+class EphemeralCoalescer:
+    def __init__(self, flush_interval=EPHEMERAL_FLUSH_INTERVAL, rate=EPHEMERAL_RATE, typing_refresh=TYPING_REFRESH):
+        self.flush_interval = flush_interval
+        self.rate = rate
+        self.typing_refresh = typing_refresh
+        # room_id -> {(user_id, kind): event} waiting for the next flush
+        self.pending = {}
+        # (room_id, user_id) -> (window_start, count)
+        self.windows = {}
+        # (room_id, user_id) -> monotonic time typing was last announced
+        self.typing_since = {}
+        self._handles = {}
+
+    def submit(self, room_id, user, event):
+        """Queue an event; returns False if it was rate limited or redundant"""
+        now = time.monotonic()
+        key = (room_id, user.id)
+        window_start, count = self.windows.get(key, (now, 0))
+        if now - window_start >= 1:
+            window_start, count = now, 0
+        if count >= self.rate:
+            return False
+        self.windows[key] = (window_start, count + 1)
+
+        if event['type'] == 'typing':
+            announced = self.typing_since.get(key)
+            if announced is not None and now - announced < self.typing_refresh:
+                return False
+            self.typing_since[key] = now
+        elif event['type'] == 'stop_typing':
+            if self.typing_since.pop(key, None) is None:
+                return False
+
+        kind = EPHEMERAL_TYPES[event['type']]
+        event = {**event, 'user': user.id, 'username': user.username}
+        self.pending.setdefault(room_id, {})[(user.id, kind)] = event
+        self._schedule(room_id)
+        return True
+
+    def forget(self, room_id, user_id):
+        """A user left the room: a pending typing state no longer applies"""
+        self.windows.pop((room_id, user_id), None)
+        if self.typing_since.pop((room_id, user_id), None) is not None:
+            self.pending.setdefault(room_id, {})[(user_id, 'typing')] = {'type': 'stop_typing', 'user': user_id}
+            self._schedule(room_id)
+
+    def _schedule(self, room_id):
+        if room_id not in self._handles:
+            self._handles[room_id] = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush(room_id))
+            )
+
+    async def flush(self, room_id):
+        self._handles.pop(room_id, None)
+        events = self.pending.pop(room_id, None)
+        if not events:
+            return
+        self._prune()
+        try:
+            await get_channel_layer().group_send(room_group_name(room_id), {
+                'type': 'ephemeral_events',
+                **encode_frame({'type': 'ephemeral', 'events': list(events.values())}),
+            })
+        except Exception:
+            logger.exception('Failed to send ephemeral events for room %s', room_id)
+
+    def _prune(self):
+        """Bound memory: drop state of users who went quiet a while ago"""
+        now = time.monotonic()
+        for key in [k for k, (start, _) in self.windows.items() if now - start >= 60]:
+            del self.windows[key]
+        for key in [k for k, since in self.typing_since.items() if now - since >= 60]:
+            del self.typing_since[key]
+
+
+ephemeral_coalescer = EphemeralCoalescer()
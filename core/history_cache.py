@@ -0,0 +1,190 @@
+"""
+Per-worker cache of the newest serialized messages of each room.
+
+Each room gets a bounded ring buffer of MessageSerializer output. Rooms are
+kept in LRU order and evicted when either the room count or the estimated
+memory cap is exceeded. A room only stays cached while this worker has at
+least one ChatConsumer in it: that consumer is a member of the room group, so
+every new message reaches this worker and the buffer can't go stale.
+"""
+import json
+import threading
+from collections import OrderedDict, deque
+from django.conf import settings
+from .pagination import encode_data_cursor
+
+HISTORY_CACHE_SIZE = getattr(settings, 'CHAT_HISTORY_CACHE_SIZE', 100)
+HISTORY_CACHE_MAX_ROOMS = getattr(settings, 'CHAT_HISTORY_CACHE_MAX_ROOMS', 1000)
+HISTORY_CACHE_MAX_BYTES = getattr(settings, 'CHAT_HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+
+class RoomHistory:
+    """Ring buffer of one room's newest messages"""
+
+    def __init__(self, has_more):
+        self.messages = deque()
+        self.sizes = deque()
+        self.nbytes = 0
+        # Whether older messages exist in the database beyond the buffer
+        self.has_more = has_more
+
+    @property
+    def last_id(self):
+        return self.messages[-1]['id'] if self.messages else 0
+
+
+class RoomHistoryCache:
+    def __init__(self, size=HISTORY_CACHE_SIZE, max_rooms=HISTORY_CACHE_MAX_ROOMS, max_bytes=HISTORY_CACHE_MAX_BYTES):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.rooms = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Local ChatConsumer count per room; rooms without one are dropped
+        self._connections = {}
+        # Rooms that received a message while a prime was in flight
+        self._uncached_writes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def connected(self, room_id):
+        with self._lock:
+            self._connections[room_id] = self._connections.get(room_id, 0) + 1
+
+    def disconnected(self, room_id):
+        with self._lock:
+            count = self._connections.get(room_id, 0) - 1
+            if count > 0:
+                self._connections[room_id] = count
+                return
+            self._connections.pop(room_id, None)
+            self._uncached_writes.pop(room_id, None)
+            self._drop(room_id)
+
+    def page(self, room_id, limit):
+        """
+        Return (messages, has_more, next_before) for the newest ``limit``
+        messages of a cached room, or None on a miss.
+        """
+        with self._lock:
+            history = self.rooms.get(room_id)
+            if history is None or (limit > len(history.messages) and history.has_more):
+                self.misses += 1
+                return None
+            self.rooms.move_to_end(room_id)
+            self.hits += 1
+            messages = list(history.messages)[-limit:] if limit else []
+            has_more = history.has_more or len(history.messages) > len(messages)
+        next_before = encode_data_cursor(messages[0]) if has_more and messages else None
+        return messages, has_more, next_before
+
+    def since(self, room_id, message_id):
+        """
+        Return the cached messages newer than ``message_id``, or None if the
+        buffer doesn't reach back that far.
+        """
+        with self._lock:
+            history = self.rooms.get(room_id)
+            if history is None or not history.messages:
+                self.misses += 1
+                return None
+            if history.has_more and history.messages[0]['id'] > message_id:
+                self.misses += 1
+                return None
+            self.rooms.move_to_end(room_id)
+            self.hits += 1
+            return [m for m in history.messages if m['id'] > message_id]
+
+    def prime_token(self, room_id):
+        """Call before loading a room from the database; pass to prime()"""
+        with self._lock:
+            return self._uncached_writes.get(room_id, 0)
+
+    def prime(self, room_id, messages, has_more, token):
+        """Seed a room with its newest messages, unless one arrived meanwhile"""
+        with self._lock:
+            if room_id not in self._connections or room_id in self.rooms:
+                return
+            if self._uncached_writes.get(room_id, 0) != token:
+                return
+            self._uncached_writes.pop(room_id, None)
+            history = RoomHistory(has_more)
+            self.rooms[room_id] = history
+            for data in messages[-self.size:]:
+                self._push(history, data)
+            if len(messages) > self.size:
+                history.has_more = True
+            self._evict()
+
+    def append(self, room_id, data):
+        """Add a persisted message to a cached room"""
+        if not isinstance(data.get('id'), int):
+            # Provisional write-behind ids are appended once persisted
+            return
+        with self._lock:
+            history = self.rooms.get(room_id)
+            if history is None:
+                if room_id in self._connections:
+                    self._uncached_writes[room_id] = self._uncached_writes.get(room_id, 0) + 1
+                return
+            if data['id'] <= history.last_id:
+                # Every local consumer delivers the same event; keep one copy
+                if any(m['id'] == data['id'] for m in reversed(history.messages)):
+                    return
+                # Out of order insert, rebuild from the database next time
+                self._drop(room_id)
+                return
+            last_seq = history.messages[-1].get('seq') if history.messages else None
+            if last_seq is not None and data.get('seq') != last_seq + 1:
+                # A message this worker never saw sits in between
+                self._drop(room_id)
+                return
+            self._push(history, data)
+            self._evict()
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._drop(room_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rooms': len(self.rooms),
+                'bytes': self.nbytes,
+            }
+
+    def _push(self, history, data):
+        size = len(json.dumps(data))
+        history.messages.append(data)
+        history.sizes.append(size)
+        history.nbytes += size
+        self.nbytes += size
+        if len(history.messages) > self.size:
+            history.messages.popleft()
+            dropped = history.sizes.popleft()
+            history.nbytes -= dropped
+            self.nbytes -= dropped
+            history.has_more = True
+
+    def _drop(self, room_id):
+        history = self.rooms.pop(room_id, None)
+        if history is not None:
+            self.nbytes -= history.nbytes
+
+    def _evict(self):
+        while self.rooms and (len(self.rooms) > self.max_rooms or self.nbytes > self.max_bytes):
+            room_id, history = self.rooms.popitem(last=False)
+            self.nbytes -= history.nbytes
+            self.evictions += 1
+
+
+history_cache = RoomHistoryCache()
@@ -0,0 +1,165 @@
+"""
+In-process channel layer for single-node deployments.
+
+``channels.layers.InMemoryChannelLayer`` is meant for tests: it deep-copies
+every message, scans all groups to expire members and wakes receivers
+through per-channel asyncio queues. This layer keeps the same semantics
+(bounded channels, message expiry, group expiry) with cheaper bookkeeping:
+
+    * groups are dicts of channel -> join time, so add/discard are O(1) and
+      group_send touches only the group's own members;
+    * each channel is a deque bounded by its capacity plus at most one waiter
+      future, so a group_send is a loop of appends with no coroutine per
+      member;
+    * messages are not copied. Group events are shared by every recipient and
+      must not be mutated after sending (the consumers in this project never
+      do).
+
+Only use it when every consumer runs in one process; there is no cross
+process delivery. Select it by starting the server with the environment
+variable ``CHAT_CHANNEL_LAYER=local`` (see settings.CHANNEL_LAYERS).
+"""
+import asyncio
+import time
+import uuid
+from collections import deque
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.group_expiry = group_expiry
+        # channel name -> deque of (expires_at, message)
+        self.channels = {}
+        # channel name -> future resolved when a message arrives
+        self.waiters = {}
+        # group name -> {channel name: joined_at}
+        self.groups = {}
+        self._next_sweep = time.time() + self.expiry
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        now = time.time()
+        if not self._put(channel, message, now + self.expiry, now):
+            raise ChannelFull(channel)
+        self._maybe_sweep(now)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        while True:
+            queue = self.channels.get(channel)
+            while queue:
+                expires_at, message = queue.popleft()
+                if expires_at > time.time():
+                    return message
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters[channel] = waiter
+            try:
+                await waiter
+            finally:
+                if self.waiters.get(channel) is waiter:
+                    del self.waiters[channel]
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}local!{uuid.uuid4().hex}'
+
+    async def flush(self):
+        self.channels.clear()
+        self.groups.clear()
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.cancel()
+        self.waiters.clear()
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, {})[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self.groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        members = self.groups.get(group)
+        if not members:
+            return
+        now = time.time()
+        expires_at = now + self.expiry
+        joined_after = now - self.group_expiry
+        stale = []
+        for channel, joined_at in members.items():
+            if joined_at < joined_after:
+                stale.append(channel)
+                continue
+            # Like the Redis layer, a full member channel just misses the event
+            self._put(channel, message, expires_at, now)
+        for channel in stale:
+            del members[channel]
+        if not members:
+            del self.groups[group]
+        self._maybe_sweep(now)
+
+    # Internals
+
+    def _put(self, channel, message, expires_at, now):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = deque()
+        elif len(queue) >= self.get_capacity(channel):
+            while queue and queue[0][0] <= now:
+                queue.popleft()
+            if len(queue) >= self.get_capacity(channel):
+                return False
+        queue.append((expires_at, message))
+        self._wake(channel)
+        return True
+
+    def _wake(self, channel):
+        waiter = self.waiters.pop(channel, None)
+        if waiter is None or waiter.done():
+            return
+        loop = waiter.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            waiter.set_result(None)
+        else:
+            # Sent from another thread's loop (e.g. async_to_sync in a view)
+            loop.call_soon_threadsafe(_resolve, waiter)
+
+    def _maybe_sweep(self, now):
+        """Drop queues nobody reads any more once all their messages expired"""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.expiry
+        for channel in [c for c, q in self.channels.items() if not q or q[-1][0] <= now]:
+            if channel not in self.waiters:
+                del self.channels[channel]
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from core.retention import archive_expired_messages, MESSAGE_RETENTION_DAYS, ARCHIVE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than each room's retention period into the "
+        "archive table. Run it from cron, or keep it running with --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=MESSAGE_RETENTION_DAYS,
+                            help='Retention for rooms without their own policy')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Repeat every INTERVAL seconds instead of running once')
+
+    def handle(self, *args, **options):
+        while True:
+            moved = archive_expired_messages(options['days'], options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f'Archived {sum(moved.values())} messages from {len(moved)} rooms'
+            ))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from core.search import get_search_backend, SEARCH_INDEX_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Add existing messages to the full-text search index, one chunk of "
+        "ids per transaction. Safe to interrupt and run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=SEARCH_INDEX_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        def progress(model, last_id, indexed):
+            self.stdout.write(f'{model.__name__}: up to id {last_id}, {indexed} rows indexed')
+
+        indexed = get_search_backend().build(options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} messages'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from core.counters import rebuild_room_counters
+from core.models import Room
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized last message and counters of rooms"
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_ids', nargs='*', type=int, help='Rooms to rebuild (default: all)')
+
+    def handle(self, *args, **options):
+        rooms = Room.objects.all()
+        if options['room_ids']:
+            rooms = rooms.filter(pk__in=options['room_ids'])
+        updated = rebuild_room_counters(rooms)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt counters of {updated} rooms'))
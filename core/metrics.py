@@ -0,0 +1,216 @@
+"""
+In-process metrics for the consumers, the auth middleware and the channel
+layer, rendered in the Prometheus text exposition format by
+``core.views.metrics`` (staff users only).
+
+Every worker process keeps its own registry; scrape each worker.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key, 0) - amount
+            if value or not labels:
+                self._values[key] = value
+            else:
+                # Drop idle label sets (e.g. empty rooms) to bound cardinality
+                self._values.pop(key, None)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value):
+        counts, count, total = value
+        lines = []
+        for bound, bucket_count in zip(self.buckets, counts):
+            labels = _format_labels(self.labelnames, key, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+        labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+        lines.append(f'{self.name}_bucket{labels} {count}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_count{labels} {count}')
+        lines.append(f'{self.name}_sum{labels} {total}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a callable refreshing gauges right before each scrape"""
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+WS_CONNECTS = registry.register(Counter(
+    'chat_ws_connects_total', 'WebSocket connections accepted', ['consumer']))
+WS_REJECTS = registry.register(Counter(
+    'chat_ws_rejects_total', 'WebSocket connections refused', ['consumer', 'reason']))
+WS_MESSAGES_RECEIVED = registry.register(Counter(
+    'chat_ws_messages_received_total', 'Frames received from clients', ['consumer', 'type']))
+WS_MESSAGES_SENT = registry.register(Counter(
+    'chat_ws_messages_sent_total', 'Frames sent to clients', ['consumer']))
+WS_ROOM_CONNECTIONS = registry.register(Gauge(
+    'chat_ws_room_connections', 'Open ChatConsumer connections per room', ['room']))
+WS_USER_CONNECTIONS = registry.register(Gauge(
+    'chat_ws_notification_connections', 'Open NotificationConsumer connections'))
+DB_CALL_SECONDS = registry.register(Histogram(
+    'chat_db_call_seconds', 'Time spent awaiting database calls', ['call']))
+DB_POOL_QUEUED = registry.register(Gauge(
+    'chat_db_pool_queued_calls', 'Database calls waiting for a pool thread', ['pool']))
+DB_POOL_ACTIVE = registry.register(Gauge(
+    'chat_db_pool_active_calls', 'Database calls running on a pool thread', ['pool']))
+DB_POOL_WAIT_SECONDS = registry.register(Histogram(
+    'chat_db_pool_wait_seconds', 'Time database calls waited for a pool thread', ['pool']))
+GROUP_SEND_SECONDS = registry.register(Histogram(
+    'chat_group_send_seconds', 'Time spent in channel layer group_send', ['event']))
+AUTH_SECONDS = registry.register(Histogram(
+    'chat_auth_seconds', 'JWTAuthMiddleware handshake authentication time', ['result']))
+HISTORY_CACHE = registry.register(Gauge(
+    'chat_history_cache', 'Room history cache counters', ['stat']))
+TOKEN_CACHE_ENTRIES = registry.register(Gauge(
+    'chat_token_cache_entries', 'Verified tokens cached by JWTAuthMiddleware'))
+OUTBOUND_QUEUED = registry.register(Gauge(
+    'chat_ws_outbound_queued_frames', 'Frames waiting in outbound connection queues', ['consumer']))
+OUTBOUND_QUEUE_DEPTH = registry.register(Histogram(
+    'chat_ws_outbound_queue_depth', 'Outbound queue depth of a connection after each enqueue', ['consumer'],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)))
+OUTBOUND_UNACKED = registry.register(Gauge(
+    'chat_ws_outbound_unacked_frames', 'Frames written to ?ack=1 clients and not acknowledged yet', ['consumer']))
+OUTBOUND_OVERFLOWS = registry.register(Counter(
+    'chat_ws_outbound_overflows_total', 'Full outbound queues, by action taken', ['consumer', 'action']))
+RATE_LIMITED = registry.register(Counter(
+    'chat_rate_limited_total', 'Frames refused by the rate limiter', ['action', 'scope']))
+
+
+def timed(histogram, **labels):
+    """Decorate a coroutine function to record its duration in ``histogram``"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def _collect_caches():
+    from .history_cache import history_cache
+    from .middleware import token_cache
+
+    for stat, value in history_cache.stats().items():
+        HISTORY_CACHE.set(value, stat=stat)
+    TOKEN_CACHE_ENTRIES.set(len(token_cache.entries))
+
+
+registry.add_collector(_collect_caches)
@@ -1,20 +1,172 @@
+import asyncio
+import copy
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from urllib.parse import parse_qs
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
+from .metrics import AUTH_SECONDS, DB_CALL_SECONDS, timed
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
-@database_sync_to_async
-def get_user(token):
+TOKEN_CACHE_SIZE = getattr(settings, 'CHAT_TOKEN_CACHE_SIZE', 10000)
+TOKEN_CACHE_TTL = getattr(settings, 'CHAT_TOKEN_CACHE_TTL', 300)
+TOKEN_CACHE_GROUP = 'chat_token_cache'
+# Re-joining keeps the group membership from expiring in the channel layer
+TOKEN_CACHE_REJOIN_INTERVAL = 3600
+
+
+class VerifiedTokenCache:
+    """
+    Per-worker LRU of verified access tokens to the user they belong to.
+    Entries expire after TOKEN_CACHE_TTL seconds and never outlive the
+    token's own ``exp`` claim.
+
+    Saving or deleting a user drops their tokens in every worker: the
+    change is published to the ``chat_token_cache`` group, which each worker
+    joins once it authenticates a connection. Changes that send no model
+    signals (``QuerySet.update``, raw SQL) are only picked up when the
+    entries expire, so TOKEN_CACHE_TTL bounds how long they go unnoticed.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tokens_by_user = {}
+        self.worker_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._listener = None
+        # Token -> lookup in progress, shared by concurrent misses
+        self._pending = {}
+
+    def get(self, token):
+        with self._lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                self._remove(token)
+                return None
+            self.entries.move_to_end(token)
+        # Connections get their own copy so nobody mutates the shared snapshot
+        return copy.copy(user)
+
+    def set(self, token, user, exp):
+        if self.max_size <= 0:
+            return
+        expires_at = min(time.time() + self.ttl, exp)
+        with self._lock:
+            self._remove(token)
+            self.entries[token] = (user, expires_at)
+            self.tokens_by_user.setdefault(user.pk, set()).add(token)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    async def load(self, token, loader):
+        """Resolve a missed token with ``loader``, once for concurrent misses"""
+        pending = self._pending.get(token)
+        if pending is None:
+            pending = asyncio.ensure_future(loader(token))
+            self._pending[token] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(token, None))
+        # A waiter that gives up doesn't cancel the lookup for the others
+        user = await asyncio.shield(pending)
+        return copy.copy(user)
+
+    def invalidate_user(self, user_id):
+        """Forget every token of a user, e.g. after deactivation"""
+        with self._lock:
+            for token in list(self.tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def publish_invalidation(self, user_id):
+        """Forget a user's tokens here and in every other worker (sync code)"""
+        self.invalidate_user(user_id)
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(TOKEN_CACHE_GROUP, {
+                'type': 'token_cache.invalidate',
+                'worker': self.worker_id,
+                'user_id': user_id,
+            })
+        except Exception:
+            logger.exception('Could not publish token invalidation for user %s', user_id)
+
+    def ensure_listener(self):
+        """Start applying other workers' invalidations (from async code)"""
+        if self.max_size <= 0 or (self._listener is not None and not self._listener.done()):
+            return
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        channel = await channel_layer.new_channel()
+        receiver = asyncio.ensure_future(self._receive_invalidations(channel_layer, channel))
+        try:
+            while True:
+                await channel_layer.group_add(TOKEN_CACHE_GROUP, channel)
+                await asyncio.sleep(TOKEN_CACHE_REJOIN_INTERVAL)
+        except Exception:
+            logger.exception('Token cache invalidation listener stopped')
+        finally:
+            receiver.cancel()
+
+    async def _receive_invalidations(self, channel_layer, channel):
+        while True:
+            message = await channel_layer.receive(channel)
+            if message.get('worker') != self.worker_id:
+                self.invalidate_user(message.get('user_id'))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def _remove(self, token):
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[0].pk
+        tokens = self.tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[user_id]
+
+
+token_cache = VerifiedTokenCache()
+
+
+@timed(DB_CALL_SECONDS, call='get_user')
+async def get_user(token):
     try:
+        # Verifying the signature is CPU work, done on the event loop; only
+        # the user lookup leaves it
         valid_token = AccessToken(token)
         user_id = valid_token['user_id']
-        return User.objects.get(id=user_id)
+        user = await User.objects.aget(id=user_id)
     except Exception:
         return AnonymousUser()
+    if not user.is_active:
+        return AnonymousUser()
+    token_cache.set(token, user, valid_token['exp'])
+    return copy.copy(user)
 
 class JWTAuthMiddleware(BaseMiddleware):
     
@@ -23,10 +175,20 @@ class JWTAuthMiddleware(BaseMiddleware):
         query_params = parse_qs(query_string)
         token_list = query_params.get('token')
         user = AnonymousUser()
+        start = time.perf_counter()
+        result = 'no_token'
         
         if token_list:
             token = token_list[0]
-            user = await get_user(token)
+            token_cache.ensure_listener()
+            # Reconnect storms re-present the same tokens; skip the thread hop
+            # and share the lookup between connections missing at once
+            user = token_cache.get(token)
+            result = 'cache_hit'
+            if user is None:
+                user = await token_cache.load(token, get_user)
+                result = 'anonymous' if user.is_anonymous else 'verified'
+        AUTH_SECONDS.observe(time.perf_counter() - start, result=result)
         
         scope['user'] = user
         return await super().__call__(scope, receive, send)
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_room_counters(apps, schema_editor):
+    Room = apps.get_model('core', 'Room')
+    Message = apps.get_model('core', 'Message')
+    members = (Room.current_users.through.objects
+               .filter(room_id=OuterRef('pk'))
+               .order_by().values('room_id')
+               .annotate(count=Count('pk')).values('count'))
+    messages = (Message.objects.filter(room_id=OuterRef('pk'))
+                .order_by().values('room_id')
+                .annotate(count=Count('pk')).values('count'))
+    latest = Message.objects.filter(room_id=OuterRef('pk')).order_by('-created_at', '-pk')
+    Room.objects.update(
+        member_count=Coalesce(Subquery(members), Value(0)),
+        message_count=Coalesce(Subquery(messages), Value(0)),
+        last_message_id=Subquery(latest.values('pk')[:1]),
+        last_activity_at=Subquery(latest.values('created_at')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_roomreadmarker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.message'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_room_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:00
+
+import core.models
+from django.db import migrations, models
+
+
+def backfill_message_seq(apps, schema_editor):
+    """Number every room's messages, archived ones first, oldest first"""
+    Room = apps.get_model('core', 'Room')
+    Message = apps.get_model('core', 'Message')
+    ArchivedMessage = apps.get_model('core', 'ArchivedMessage')
+    for room_id in Room.objects.values_list('pk', flat=True):
+        seq = 0
+        for model in (ArchivedMessage, Message):
+            rows = list(model.objects.filter(room_id=room_id).order_by('created_at', 'pk').only('pk'))
+            for row in rows:
+                seq += 1
+                row.seq = seq
+            model.objects.bulk_update(rows, ['seq'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=core.models.SequenceField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_message_seq, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='unique_message_room_seq'),
+        ),
+    ]
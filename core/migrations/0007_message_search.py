@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:00
+
+from django.db import migrations
+
+
+def install_search_index(apps, schema_editor):
+    from core.search import SEARCH_BACKEND
+    from django.utils.module_loading import import_string
+
+    backend = import_string(SEARCH_BACKEND)()
+    if backend.supports(schema_editor.connection):
+        # Existing rows are indexed by `manage.py build_search_index`
+        backend.install(schema_editor.connection)
+
+
+def uninstall_search_index(apps, schema_editor):
+    from core.search import SEARCH_BACKEND
+    from django.utils.module_loading import import_string
+
+    backend = import_string(SEARCH_BACKEND)()
+    if backend.supports(schema_editor.connection):
+        backend.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
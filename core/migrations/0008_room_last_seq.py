@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_last_seq(apps, schema_editor):
+    """Continue every room's numbering after its highest hot or archived seq"""
+    Room = apps.get_model('core', 'Room')
+    Message = apps.get_model('core', 'Message')
+    ArchivedMessage = apps.get_model('core', 'ArchivedMessage')
+    newest = {}
+    for model in (Message, ArchivedMessage):
+        rows = model.objects.order_by().values('room_id').annotate(seq=Max('seq')).values_list('room_id', 'seq')
+        for room_id, seq in rows:
+            newest[room_id] = max(newest.get(room_id, 0), seq or 0)
+    for room_id, seq in newest.items():
+        Room.objects.filter(pk=room_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_last_seq, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
 # Create your models here.
@@ -40,6 +42,63 @@ class User(AbstractUser):
             return self.username
         return self.email
 
+class RoomQuerySet(models.QuerySet):
+    def for_user(self, user):
+        """Rooms the user created or is a member of"""
+        memberships = Room.current_users.through.objects.filter(user_id=user.pk)
+        return self.filter(Q(creator=user) | Q(pk__in=memberships.values('room_id')))
+
+    def with_summary(self, user):
+        """
+        Annotate the user's unread_count with a correlated subquery and join
+        the denormalized last message, so a listing costs one query however
+        many rooms there are.
+        """
+        last_read = (RoomReadMarker.objects
+                     .filter(room_id=OuterRef('pk'), user_id=user.pk)
+                     .values('last_read_message_id')[:1])
+        unread = (Message.objects
+                  .filter(room_id=OuterRef('pk'), pk__gt=OuterRef('last_read_id'))
+                  .exclude(user_id=user.pk)
+                  .order_by().values('room_id')
+                  .annotate(count=Count('pk')).values('count'))
+        return self.select_related('last_message__user').annotate(
+            last_read_id=Coalesce(Subquery(last_read), Value(0), output_field=models.BigIntegerField()),
+        ).annotate(
+            unread_count=Coalesce(Subquery(unread), Value(0)),
+        )
+
+    def reserve_seq(self, room_id, count=1):
+        """
+        Take ``count`` message sequence numbers from the room's counter and
+        return the first. Call it in the transaction that inserts the
+        messages: the UPDATE holds the room row (SQLite: the write lock) until
+        commit, so writers take turns, and a rollback hands the numbers back.
+
+        One UPDATE ... RETURNING where the database has it (PostgreSQL,
+        SQLite 3.35+), otherwise an UPDATE and a SELECT. Either way a
+        single-message insert costs this, the INSERT and the counter UPDATE
+        of record_messages.
+        """
+        connection = connections[self.db]
+        if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+            quote = connection.ops.quote_name
+            table = quote(self.model._meta.db_table)
+            pk = quote(self.model._meta.pk.column)
+            last_seq = quote(self.model._meta.get_field('last_seq').column)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET {last_seq} = {last_seq} + %s WHERE {pk} = %s RETURNING {last_seq}',
+                    [count, room_id],
+                )
+                row = cursor.fetchone()
+            if row is None:
+                raise self.model.DoesNotExist('Room matching query does not exist.')
+            return row[0] - count + 1
+        self.filter(pk=room_id).update(last_seq=F('last_seq') + count)
+        return self.filter(pk=room_id).values_list('last_seq', flat=True).get() - count + 1
+
+
 class Room(models.Model):
     name = models.CharField(max_length=255, null=True, blank=True)
     creator = models.ForeignKey(
@@ -50,16 +109,89 @@ class Room(models.Model):
     current_users = models.ManyToManyField(
         User, related_name="current_rooms", blank=True
     )
+    # Denormalized, maintained by core.counters on every write
+    last_message = models.ForeignKey(
+        "Message", on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    last_activity_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    message_count = models.PositiveIntegerField(default=0)
+    # Newest message sequence number handed out; deletes never lower it
+    last_seq = models.PositiveBigIntegerField(default=0)
+    member_count = models.PositiveIntegerField(default=0)
+    # Days messages stay in the hot table before being archived; None uses
+    # settings.CHAT_MESSAGE_RETENTION_DAYS and 0 keeps them forever
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    objects = RoomQuerySet.as_manager()
 
     def __str__(self):
         return f"Room({self.name})"
         
 
+class SequenceField(models.PositiveBigIntegerField):
+    """Column of Message.seq, numbered by Message.save from Room.last_seq"""
+
+
 class Message(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="messages")
     text = models.TextField(max_length=500)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="messages")
     created_at = models.DateTimeField(auto_now_add=True)
+    # Per-room position from Room.last_seq, never reused; lets clients detect
+    # missed messages (a deleted message leaves its number unused)
+    seq = SequenceField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of room history walks (room, created_at, id)
+            models.Index(fields=['room', 'created_at', 'id'], name='message_room_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='unique_message_room_seq'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding or self.seq is not None:
+            return super().save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(Message, instance=self)
+        # Numbered in the INSERT's transaction, so a failed insert uses no number
+        with transaction.atomic(using=using):
+            self.seq = Room.objects.using(using).reserve_seq(self.room_id)
+            super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"Message({self.user} {self.room})"
+
+
+class RoomReadMarker(models.Model):
+    """Newest message a user has read in a room, used for unread counts"""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="read_markers")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_markers")
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='unique_room_read_marker'),
+        ]
+
+    def __str__(self):
+        return f"RoomReadMarker({self.user} {self.room} {self.last_read_message_id})"
+
+
+class ArchivedMessage(models.Model):
+    """Message moved out of the hot Message table by core.retention"""
+    id = models.BigIntegerField(primary_key=True)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="archived_messages")
+    text = models.TextField(max_length=500)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="archived_messages")
+    created_at = models.DateTimeField()
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'created_at', 'id'], name='archived_room_created_idx'),
+        ]
 
     def __str__(self):
-        return f"Message({self.user} {self.room})"
\ No newline at end of file
+        return f"ArchivedMessage({self.user} {self.room})"
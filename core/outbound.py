@@ -0,0 +1,254 @@
+"""
+Outbound flow control for WebSocket consumers.
+
+Handlers never await the server's send: they append frames to a
+per-connection queue and return, and one writer task per connection
+forwards them to the server. What bounds a slow client's backlog depends
+on the server:
+
+    * servers that apply backpressure (uvicorn, hypercorn) make the writer
+      wait, so frames pile up in the queue. It holds at most
+      ``CHAT_OUTBOUND_QUEUE_SIZE`` frames and ``CHAT_OUTBOUND_QUEUE_BYTES``
+      bytes.
+    * daphne, which this project runs, writes every frame into Twisted's
+      transport buffer and returns at once. The queue drains immediately
+      and never fills; a slow client's frames accumulate in that unbounded
+      buffer instead. The queue limits do not bound memory there.
+
+To bound a connection under daphne, its client acknowledges delivery by
+sending ``{"type": "ack", "received": N}`` (N = data frames received on
+this connection so far) every few frames or so. Frames written but not
+acknowledged are the real backlog; it may reach
+``CHAT_OUTBOUND_UNACKED_FRAMES`` frames and ``CHAT_OUTBOUND_UNACKED_BYTES``
+bytes. With ``CHAT_OUTBOUND_REQUIRE_ACKS`` (the default) this applies to
+every connection, so a client that never acknowledges hits the limit like
+one that stopped reading. Turning it off makes acks opt-in with
+``?ack=1``; connections without them then have no server-side bound under
+daphne beyond TCP and the OS.
+
+Ephemeral frames (typing, presence) are dropped first: the oldest queued
+one when the queue is full, and every new one while the unacknowledged
+backlog is over half its limit. Beyond that, ``CHAT_OUTBOUND_POLICY``
+decides what happens when either limit is crossed:
+
+    ``resync``      drop everything queued and send a single
+                    ``{"type": "resync_required"}`` frame; nothing else is
+                    sent until the client acknowledges it (acking clients)
+                    or it is written (others). The client then reloads
+                    history and follows the live stream again
+    ``disconnect``  drop everything queued and close the connection with
+                    code 4008
+"""
+import asyncio
+import json
+from collections import deque
+from django.conf import settings
+from urllib.parse import parse_qs
+from .metrics import OUTBOUND_QUEUED, OUTBOUND_QUEUE_DEPTH, OUTBOUND_OVERFLOWS, OUTBOUND_UNACKED
+
+OUTBOUND_QUEUE_SIZE = getattr(settings, 'CHAT_OUTBOUND_QUEUE_SIZE', 256)
+OUTBOUND_QUEUE_BYTES = getattr(settings, 'CHAT_OUTBOUND_QUEUE_BYTES', 1024 * 1024)
+OUTBOUND_POLICY = getattr(settings, 'CHAT_OUTBOUND_POLICY', 'resync')
+OUTBOUND_UNACKED_FRAMES = getattr(settings, 'CHAT_OUTBOUND_UNACKED_FRAMES', 512)
+OUTBOUND_UNACKED_BYTES = getattr(settings, 'CHAT_OUTBOUND_UNACKED_BYTES', 4 * 1024 * 1024)
+OUTBOUND_REQUIRE_ACKS = getattr(settings, 'CHAT_OUTBOUND_REQUIRE_ACKS', True)
+SLOW_CONSUMER_CLOSE_CODE = 4008
+RESYNC_FRAME = {'type': 'resync_required'}
+
+
+class OutboundQueueMixin:
+    """Queues frames sent by a consumer and writes them from a single task"""
+
+    outbound_limit = OUTBOUND_QUEUE_SIZE
+    outbound_byte_limit = OUTBOUND_QUEUE_BYTES
+    outbound_policy = OUTBOUND_POLICY
+    outbound_unacked_limit = OUTBOUND_UNACKED_FRAMES
+    outbound_unacked_byte_limit = OUTBOUND_UNACKED_BYTES
+    outbound_require_acks = OUTBOUND_REQUIRE_ACKS
+    metrics_name = 'consumer'
+
+    # Set by negotiate_outbound_acks
+    outbound_acks = False
+
+    _outbound = None
+    _outbound_writer = None
+    # Sizes of frames written but not acknowledged yet, oldest first
+    _unacked = None
+    _unacked_bytes = 0
+    _outbound_written = 0
+    _outbound_acked = 0
+    # The resync marker until it reaches the client, and its frame number
+    # once written (acking clients only)
+    _outbound_resync = None
+    _outbound_resync_at = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False, ephemeral=False):
+        if text_data is not None:
+            self._enqueue({'type': 'websocket.send', 'text': text_data}, len(text_data), ephemeral)
+        elif bytes_data is not None:
+            self._enqueue({'type': 'websocket.send', 'bytes': bytes_data}, len(bytes_data), ephemeral)
+        elif not close:
+            raise ValueError('You must pass one of bytes_data or text_data')
+        if close:
+            await self.close(close)
+
+    async def close(self, code=None, reason=None):
+        if self._outbound:
+            # Let the frames queued so far go out first
+            self._enqueue(('close', code, reason), 0, False, force=True)
+        else:
+            await self._close_now(code, reason)
+
+    def negotiate_outbound_acks(self):
+        """Turn on delivery acks if required or the client connected with ?ack=1"""
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        self.outbound_acks = (
+            self.outbound_require_acks or query_params.get('ack', ['0'])[0] in ('1', 'true')
+        )
+
+    def acknowledge_outbound(self, received):
+        """Apply an ack frame: ``received`` data frames reached the client"""
+        if not self.outbound_acks or not isinstance(received, int) or isinstance(received, bool):
+            return
+        received = min(received, self._outbound_written)
+        count = received - self._outbound_acked
+        if count <= 0:
+            return
+        self._outbound_acked = received
+        for _ in range(count):
+            self._unacked_bytes -= self._unacked.popleft()
+        OUTBOUND_UNACKED.dec(count, consumer=self.metrics_name)
+        if self._outbound_resync_at is not None and received >= self._outbound_resync_at:
+            self._outbound_resync = self._outbound_resync_at = None
+
+    async def websocket_disconnect(self, message):
+        self._discard_outbound()
+        if self._unacked:
+            OUTBOUND_UNACKED.dec(len(self._unacked), consumer=self.metrics_name)
+            self._unacked.clear()
+        if self._outbound_writer is not None:
+            self._outbound_writer.cancel()
+        await super().websocket_disconnect(message)
+
+    def outbound_marker(self):
+        """The websocket.send message telling a client to resync"""
+        return {'type': 'websocket.send', 'text': json.dumps(RESYNC_FRAME)}
+
+    # Internals
+
+    def _enqueue(self, message, size, ephemeral, force=False):
+        if self._outbound is None:
+            self._outbound = deque()
+            self._outbound_bytes = 0
+            self._outbound_closing = False
+        queue = self._outbound
+        if not force and (self._outbound_closing or self._outbound_resync is not None):
+            # Closing, or the client is about to reload everything anyway
+            return
+        if ephemeral and self._unacked and len(self._unacked) * 2 >= self.outbound_unacked_limit:
+            OUTBOUND_OVERFLOWS.inc(consumer=self.metrics_name, action='drop_ephemeral')
+            return
+
+        while not force and queue and (
+            len(queue) >= self.outbound_limit or self._outbound_bytes + size > self.outbound_byte_limit
+        ):
+            if not self._shed(ephemeral):
+                return
+
+        queue.append((message, size, ephemeral))
+        self._outbound_bytes += size
+        OUTBOUND_QUEUED.inc(consumer=self.metrics_name)
+        OUTBOUND_QUEUE_DEPTH.observe(len(queue), consumer=self.metrics_name)
+        if isinstance(message, tuple):
+            self._outbound_closing = True
+
+        if self._outbound_writer is None or self._outbound_writer.done():
+            self._outbound_writer = asyncio.ensure_future(self._write_outbound())
+
+    def _shed(self, ephemeral):
+        """Make room in a full queue; returns False to drop the new frame"""
+        queue = self._outbound
+        for index, (_, size, queued_ephemeral) in enumerate(queue):
+            if queued_ephemeral:
+                del queue[index]
+                self._outbound_bytes -= size
+                OUTBOUND_QUEUED.dec(consumer=self.metrics_name)
+                OUTBOUND_OVERFLOWS.inc(consumer=self.metrics_name, action='drop_ephemeral')
+                return True
+        if ephemeral:
+            OUTBOUND_OVERFLOWS.inc(consumer=self.metrics_name, action='drop_ephemeral')
+            return False
+
+        self._discard_outbound()
+        if self.outbound_policy == 'disconnect':
+            OUTBOUND_OVERFLOWS.inc(consumer=self.metrics_name, action='disconnect')
+            self._enqueue(('close', SLOW_CONSUMER_CLOSE_CODE, None), 0, False, force=True)
+        else:
+            self._resync()
+        # Whatever triggered the overflow is covered by the resync or the close
+        return False
+
+    def _resync(self):
+        """Replace everything queued with the resync marker"""
+        OUTBOUND_OVERFLOWS.inc(consumer=self.metrics_name, action='resync')
+        self._outbound_resync = self.outbound_marker()
+        self._enqueue(self._outbound_resync, 0, False, force=True)
+
+    def _discard_outbound(self):
+        if self._outbound:
+            OUTBOUND_QUEUED.dec(len(self._outbound), consumer=self.metrics_name)
+            self._outbound.clear()
+            self._outbound_bytes = 0
+
+    async def _write_outbound(self):
+        queue = self._outbound
+        while queue:
+            message, size, _ = queue.popleft()
+            self._outbound_bytes -= size
+            OUTBOUND_QUEUED.dec(consumer=self.metrics_name)
+            if isinstance(message, tuple):
+                _, code, reason = message
+                self._discard_outbound()
+                await self._close_now(code, reason)
+                return
+            try:
+                await self.base_send(message)
+            except Exception:
+                # The client went away; websocket_disconnect cleans up
+                self._discard_outbound()
+                return
+            self._outbound_written += 1
+            if message is self._outbound_resync:
+                if self.outbound_acks:
+                    # Hold everything back until the client has it
+                    self._outbound_resync_at = self._outbound_written
+                else:
+                    self._outbound_resync = None
+            if self.outbound_acks and not await self._track_unacked(size):
+                return
+
+    async def _track_unacked(self, size):
+        """Count a written frame; returns False if the connection was closed"""
+        if self._unacked is None:
+            self._unacked = deque()
+        self._unacked.append(size)
+        self._unacked_bytes += size
+        OUTBOUND_UNACKED.inc(consumer=self.metrics_name)
+        if self._outbound_resync is not None or (
+            len(self._unacked) <= self.outbound_unacked_limit
+            and self._unacked_bytes <= self.outbound_unacked_byte_limit
+        ):
+            return True
+
+        # The client is not reading; what was written cannot be taken back
+        self._discard_outbound()
+        if self.outbound_policy == 'disconnect':
+            OUTBOUND_OVERFLOWS.inc(consumer=self.metrics_name, action='disconnect')
+            self._outbound_closing = True
+            await self._close_now(SLOW_CONSUMER_CLOSE_CODE, None)
+            return False
+        self._resync()
+        return True
+
+    async def _close_now(self, code, reason):
+        await super().close(code=code, reason=reason)
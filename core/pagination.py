@@ -0,0 +1,77 @@
+from datetime import datetime
+from django.conf import settings
+from django.db.models import Q
+
+HISTORY_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+HISTORY_MAX_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+# Most messages a reconnecting client is sent by delta sync before it is
+# told to resync from the newest page instead
+SYNC_MAX_MESSAGES = getattr(settings, 'CHAT_SYNC_MAX_MESSAGES', HISTORY_MAX_PAGE_SIZE)
+# Most messages one replay of a sequence gap returns
+REPLAY_MAX_MESSAGES = getattr(settings, 'CHAT_REPLAY_MAX_MESSAGES', HISTORY_MAX_PAGE_SIZE)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(message):
+    """Build an opaque keyset cursor from a message's (created_at, id)"""
+    return f"{message.created_at.isoformat()}|{message.pk}"
+
+
+def encode_data_cursor(data):
+    """Build the same cursor from a serialized message"""
+    return f"{data['created_at']}|{data['id']}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into a (created_at, id) tuple"""
+    try:
+        created_at, pk = str(cursor).rsplit('|', 1)
+        # DRF renders UTC as a trailing 'Z'
+        if created_at.endswith('Z'):
+            created_at = created_at[:-1] + '+00:00'
+        return datetime.fromisoformat(created_at), int(pk)
+    except (TypeError, ValueError):
+        raise InvalidCursor(f'Invalid cursor: {cursor!r}')
+
+
+def clamp_limit(limit):
+    """Keep client supplied page sizes within the configured bounds"""
+    if limit is None:
+        return HISTORY_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return HISTORY_PAGE_SIZE
+    return max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+
+def before_cursor(queryset, cursor):
+    """Restrict a message queryset to rows strictly older than the cursor"""
+    if not cursor:
+        return queryset
+    created_at, pk = decode_cursor(cursor)
+    return queryset.filter(
+        Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+    )
+
+
+def latest_page(queryset, cursor=None, limit=None):
+    """
+    Return (messages, has_more, next_before) for the newest page older than
+    ``cursor``. Messages come back in chronological order.
+    """
+    return latest_rows(queryset, cursor, clamp_limit(limit))
+
+
+def latest_rows(queryset, cursor, limit):
+    """Same as latest_page but trusts ``limit`` as given"""
+    queryset = before_cursor(queryset, cursor).order_by('-created_at', '-pk')
+    rows = list(queryset[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    next_before = encode_cursor(rows[0]) if has_more and rows else None
+    return rows, has_more, next_before
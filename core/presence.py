@@ -0,0 +1,184 @@
+"""
+Who is online in each room, answered without touching the database.
+
+Every worker owns a PresenceTracker. ChatConsumer registers its connection
+with it, and the tracker periodically announces this worker's roster of each
+changed room to the room group as one ``presence_state`` event carrying the
+full local user list. Workers merge those states into a view of the whole
+room, so the ``presence`` query is a set union in memory.
+
+Traffic stays linear in a reconnect storm: joins and leaves are coalesced
+per room for ``CHAT_PRESENCE_FLUSH_INTERVAL`` seconds, so W workers send at
+most W events per interval per room however many users (re)connect. Each
+event is applied once per worker (memoized by event id) and the resulting
+``presence_diff`` frame is encoded once per worker.
+
+Rosters are refreshed every ``CHAT_PRESENCE_HEARTBEAT`` seconds and expire
+after three missed heartbeats, which clears users of a crashed worker.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .broadcast import room_group_name
+from .codecs import encode_frame
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_FLUSH_INTERVAL = getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 0.5)
+PRESENCE_HEARTBEAT = getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 30)
+PRESENCE_TTL = PRESENCE_HEARTBEAT * 3
+APPLIED_EVENTS_KEPT = 1024
+
+
+class PresenceTracker:
+    def __init__(self, flush_interval=PRESENCE_FLUSH_INTERVAL, heartbeat=PRESENCE_HEARTBEAT, ttl=PRESENCE_TTL):
+        self.worker_id = uuid.uuid4().hex
+        self.flush_interval = flush_interval
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        # room_id -> {channel_name: user_id} for this worker's connections
+        self.local = {}
+        # room_id -> {worker_id: (frozenset(user_ids), expires_at)}
+        self.rosters = {}
+        # Rooms whose local roster must be announced at the next flush
+        self.dirty = set()
+        # Rooms that just became active here and need everyone's roster
+        self.syncing = set()
+        # event id -> encoded presence_diff frame (or None when nothing changed)
+        self.applied = OrderedDict()
+        self._task = None
+        self._next_heartbeat = 0
+
+    # Connections
+
+    def connected(self, room_id, channel_name, user_id):
+        members = self.local.setdefault(room_id, {})
+        if not members:
+            self.syncing.add(room_id)
+        members[channel_name] = user_id
+        self.dirty.add(room_id)
+        self._ensure_started()
+
+    def disconnected(self, room_id, channel_name):
+        members = self.local.get(room_id)
+        if members is None or members.pop(channel_name, None) is None:
+            return
+        self.dirty.add(room_id)
+
+    def online(self, room_id):
+        """
+        User ids online in a room across all workers. Built from announced
+        rosters only (this worker's included), so every worker agrees on it;
+        local changes show up after the next flush.
+        """
+        return sorted(self._online(room_id, time.monotonic()))
+
+    def _online(self, room_id, now):
+        users = set()
+        for roster, expires_at in self.rosters.get(room_id, {}).values():
+            if expires_at > now:
+                users |= roster
+        return users
+
+    # Events from the room group
+
+    def apply(self, room_id, event):
+        """
+        Merge a presence_state event and return the encoded presence_diff
+        frame for clients, or None if the room's online set did not change.
+        Every local consumer calls this; the work happens once per worker.
+        """
+        event_id = event['id']
+        if event_id in self.applied:
+            return self.applied[event_id]
+
+        if event.get('sync') and event['worker'] != self.worker_id and room_id in self.local:
+            # A worker just started serving this room; send it our roster
+            self.dirty.add(room_id)
+
+        now = time.monotonic()
+        before = self._online(room_id, now)
+        rosters = self.rosters.setdefault(room_id, {})
+        users = frozenset(event['users'])
+        if users:
+            rosters[event['worker']] = (users, now + self.ttl)
+        else:
+            rosters.pop(event['worker'], None)
+        frame = self._diff_frame(before, self._online(room_id, now))
+
+        self.applied[event_id] = frame
+        while len(self.applied) > APPLIED_EVENTS_KEPT:
+            self.applied.popitem(last=False)
+        return frame
+
+    # Background flushing
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self.local:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Presence flush failed')
+
+    async def flush(self):
+        """Announce changed rosters, send heartbeats and expire stale ones"""
+        channel_layer = get_channel_layer()
+        now = time.monotonic()
+        if now >= self._next_heartbeat:
+            self._next_heartbeat = now + self.heartbeat
+            self.dirty.update(self.local)
+
+        dirty, self.dirty = self.dirty, set()
+        for room_id in dirty:
+            members = self.local.get(room_id, {})
+            await channel_layer.group_send(room_group_name(room_id), {
+                'type': 'presence_state',
+                'id': uuid.uuid4().hex,
+                'worker': self.worker_id,
+                'users': sorted(set(members.values())),
+                'sync': room_id in self.syncing,
+            })
+            self.syncing.discard(room_id)
+            if not members:
+                # Nobody here any more: stop tracking the room on this worker
+                self.local.pop(room_id, None)
+                self.rosters.pop(room_id, None)
+
+        await self._expire(channel_layer, now)
+
+    async def _expire(self, channel_layer, now):
+        for room_id, rosters in list(self.rosters.items()):
+            stale = [worker for worker, (_, expires_at) in rosters.items() if expires_at <= now]
+            if not stale:
+                continue
+            # Compare against the view as it was while the rosters were live
+            before = self._online(room_id, 0)
+            for worker in stale:
+                del rosters[worker]
+            frame = self._diff_frame(before, self._online(room_id, now))
+            if frame is None:
+                continue
+            # Every worker expires on its own, so only tell local consumers
+            for channel_name in list(self.local.get(room_id, {})):
+                await channel_layer.send(channel_name, {'type': 'presence_diff', **frame})
+
+    def _diff_frame(self, before, after):
+        if before == after:
+            return None
+        return encode_frame({
+            'type': 'presence_diff',
+            'joined': sorted(after - before),
+            'left': sorted(before - after),
+        })
+
+
+presence_tracker = PresenceTracker()
@@ -0,0 +1,165 @@
+"""
+Token bucket rate limits for ChatConsumer actions.
+
+``CHAT_RATE_LIMITS`` maps an action (a frame type) to the buckets it draws
+from, keyed by user and/or room, each as ``(tokens per second, burst)``.
+An action passes only if every bucket it uses has a token; the consumer
+answers a refused frame with::
+
+    {"type": "error", "code": "rate_limited", "action": ..., "retry_after": ...}
+
+Buckets live in each worker. With ``CHAT_RATE_LIMIT_SYNC`` enabled, workers
+also publish what they consumed to the ``chat_ratelimit`` group every
+``CHAT_RATE_LIMIT_SYNC_INTERVAL`` seconds and debit each other's buckets, so
+a user spread over several workers shares one budget (within one interval).
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .metrics import RATE_LIMITED
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITS = getattr(settings, 'CHAT_RATE_LIMITS', {
+    'chat_message': {'user': (5, 10), 'room': (50, 100)},
+    'get_messages': {'user': (2, 5)},
+    'sync': {'user': (2, 5)},
+    'replay': {'user': (2, 5)},
+})
+RATE_LIMIT_MAX_KEYS = getattr(settings, 'CHAT_RATE_LIMIT_MAX_KEYS', 100000)
+RATE_LIMIT_SYNC = getattr(settings, 'CHAT_RATE_LIMIT_SYNC', False)
+RATE_LIMIT_SYNC_INTERVAL = getattr(settings, 'CHAT_RATE_LIMIT_SYNC_INTERVAL', 0.5)
+RATE_LIMIT_GROUP = 'chat_ratelimit'
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, cost=1):
+        """Seconds until ``cost`` tokens are available (0 if they are)"""
+        missing = cost - self.tokens
+        return max(0.0, missing / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, max_keys=RATE_LIMIT_MAX_KEYS, sync=RATE_LIMIT_SYNC,
+                 sync_interval=RATE_LIMIT_SYNC_INTERVAL):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.worker_id = uuid.uuid4().hex
+        # (action, scope, key) -> TokenBucket, least recently used first
+        self.buckets = OrderedDict()
+        # (action, scope, key) -> tokens taken here since the last publish
+        self.usage = {}
+        self._sync_task = None
+
+    def check(self, action, user_id, room_id=None):
+        """
+        Take a token from each bucket of ``action``. Returns 0 when allowed,
+        otherwise the seconds to wait before retrying.
+        """
+        limits = self.limits.get(action) if isinstance(action, str) else None
+        if not limits:
+            return 0
+        now = time.monotonic()
+        keys = {'user': user_id, 'room': room_id}
+        buckets = []
+        for scope, (rate, burst) in limits.items():
+            if keys.get(scope) is None:
+                continue
+            bucket_key = (action, scope, str(keys[scope]))
+            bucket = self._bucket(bucket_key, rate, burst, now)
+            bucket.refill(now)
+            buckets.append((bucket_key, bucket))
+
+        wait = max((bucket.retry_after() for _, bucket in buckets), default=0)
+        if wait:
+            limited = next(key for key, bucket in buckets if bucket.retry_after())
+            RATE_LIMITED.inc(action=action, scope=limited[1])
+            return wait
+
+        for bucket_key, bucket in buckets:
+            bucket.tokens -= 1
+            if self.sync:
+                self.usage[bucket_key] = self.usage.get(bucket_key, 0) + 1
+        if self.sync:
+            self._ensure_sync()
+        return 0
+
+    def _bucket(self, bucket_key, rate, burst, now):
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self.buckets[bucket_key] = TokenBucket(rate, burst, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(bucket_key)
+        return bucket
+
+    # Cross-worker coordination
+
+    def _ensure_sync(self):
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.ensure_future(self._run_sync())
+
+    async def _run_sync(self):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        receiver = asyncio.ensure_future(self._receive_usage(channel_layer, channel))
+        try:
+            while True:
+                # Re-joining keeps the membership from expiring
+                await channel_layer.group_add(RATE_LIMIT_GROUP, channel)
+                await asyncio.sleep(self.sync_interval)
+                await self.publish(channel_layer)
+        except Exception:
+            logger.exception('Rate limit sync stopped')
+        finally:
+            receiver.cancel()
+
+    async def publish(self, channel_layer):
+        usage, self.usage = self.usage, {}
+        if not usage:
+            return
+        await channel_layer.group_send(RATE_LIMIT_GROUP, {
+            'type': 'rate_limit.usage',
+            'worker': self.worker_id,
+            'usage': [[action, scope, key, count] for (action, scope, key), count in usage.items()],
+        })
+
+    async def _receive_usage(self, channel_layer, channel):
+        while True:
+            message = await channel_layer.receive(channel)
+            if message.get('worker') != self.worker_id:
+                self.apply_usage(message.get('usage', []))
+
+    def apply_usage(self, usage):
+        """Debit tokens another worker took; buckets may go negative"""
+        now = time.monotonic()
+        for action, scope, key, count in usage:
+            limit = self.limits.get(action, {}).get(scope)
+            if limit is None:
+                continue
+            bucket = self._bucket((action, scope, key), limit[0], limit[1], now)
+            bucket.refill(now)
+            # Never owe more than one burst, so a user is not locked out for long
+            bucket.tokens = max(-bucket.burst, bucket.tokens - count)
+
+
+rate_limiter = RateLimiter()
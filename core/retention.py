@@ -0,0 +1,139 @@
+"""
+Message retention: old messages move from the hot Message table into
+ArchivedMessage so history queries only ever scan recent rows.
+
+A room's ``retention_days`` decides how long its messages stay hot; rooms
+without one use ``CHAT_MESSAGE_RETENTION_DAYS`` (None disables archiving).
+The newest message of a room is never archived, it backs Room.last_message.
+
+Reads are transparent: ``room_history_rows`` continues into the archive when
+a page reaches past the hot window, with the same cursors.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ArchivedMessage, Message, Room
+from .pagination import before_cursor, encode_cursor, latest_rows, REPLAY_MAX_MESSAGES
+
+MESSAGE_RETENTION_DAYS = getattr(settings, 'CHAT_MESSAGE_RETENTION_DAYS', None)
+ARCHIVE_BATCH_SIZE = getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 1000)
+
+
+def retention_days_for(room, default=MESSAGE_RETENTION_DAYS):
+    days = room.retention_days if room.retention_days is not None else default
+    return days or None
+
+
+def archive_room_messages(room, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move a room's messages older than ``cutoff`` into the archive"""
+    moved = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Message.objects.filter(room=room, created_at__lt=cutoff)
+                .exclude(pk=room.last_message_id)
+                .order_by('created_at', 'pk')[:batch_size]
+            )
+            if not batch:
+                return moved
+            ArchivedMessage.objects.bulk_create([
+                ArchivedMessage(
+                    id=message.pk,
+                    room_id=message.room_id,
+                    user_id=message.user_id,
+                    text=message.text,
+                    created_at=message.created_at,
+                    seq=message.seq,
+                ) for message in batch
+            ], ignore_conflicts=True)
+            Message.objects.filter(pk__in=[message.pk for message in batch]).delete()
+        moved += len(batch)
+
+
+def archive_expired_messages(default_days=MESSAGE_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE, now=None):
+    """Apply every room's retention policy; returns {room_id: moved}"""
+    now = now or timezone.now()
+    rooms = Room.objects.all()
+    if not default_days:
+        rooms = rooms.filter(retention_days__gt=0)
+    moved = {}
+    for room in list(rooms):
+        days = retention_days_for(room, default_days)
+        if days is None:
+            continue
+        count = archive_room_messages(room, now - timedelta(days=days), batch_size)
+        if count:
+            moved[room.pk] = count
+    return moved
+
+
+def archived_rows(room_id, cursor, limit):
+    """Newest archived messages older than ``cursor``, as unsaved Messages"""
+    queryset = ArchivedMessage.objects.filter(room_id=room_id).select_related('user')
+    rows, has_more, _ = latest_rows(queryset, cursor, limit)
+    return [as_message(row) for row in rows], has_more
+
+
+def as_message(row):
+    """An archived row as an unsaved Message, so MessageSerializer renders it identically"""
+    return Message(id=row.pk, room_id=row.room_id, user=row.user, text=row.text, created_at=row.created_at, seq=row.seq)
+
+
+def rows_after(room_id, message_id, limit):
+    """
+    Return the room's messages newer than ``message_id`` (oldest first), or
+    None if there are more than ``limit`` of them.
+    """
+    if ArchivedMessage.objects.filter(room_id=room_id, pk__gt=message_id).exists():
+        # Part of the gap was archived already; far too old to catch up on
+        return None
+    messages = list(
+        Message.objects.filter(room_id=room_id, pk__gt=message_id)
+        .select_related('user').order_by('pk')[:limit + 1]
+    )
+    return messages if len(messages) <= limit else None
+
+
+def rows_in_seq_range(room_id, after_seq, until_seq=None, limit=REPLAY_MAX_MESSAGES):
+    """
+    Return (messages, has_more) for the room's messages with a sequence
+    number above ``after_seq`` and up to ``until_seq``, at most ``limit``.
+    Archived messages keep their numbers, so when the range starts before
+    the oldest hot match the archive supplies the rest.
+    """
+    queryset = Message.objects.filter(room_id=room_id, seq__gt=after_seq)
+    if until_seq is not None:
+        queryset = queryset.filter(seq__lte=until_seq)
+    messages = list(queryset.select_related('user').order_by('seq')[:limit + 1])
+
+    if not messages or messages[0].seq > after_seq + 1:
+        archived = ArchivedMessage.objects.filter(room_id=room_id, seq__gt=after_seq)
+        if messages:
+            archived = archived.filter(seq__lt=messages[0].seq)
+        elif until_seq is not None:
+            archived = archived.filter(seq__lte=until_seq)
+        rows = archived.select_related('user').order_by('seq')[:limit + 1]
+        messages = [as_message(row) for row in rows] + messages
+    return messages[:limit], len(messages) > limit
+
+
+def room_history_rows(room_id, cursor, limit):
+    """
+    Return (messages, has_more, next_before) for the newest ``limit`` messages
+    older than ``cursor``, reading the archive once the hot table runs out.
+    """
+    queryset = Message.objects.filter(room_id=room_id).select_related('user')
+    messages, has_more, _ = latest_rows(queryset, cursor, limit)
+
+    if not has_more:
+        older_than = encode_cursor(messages[0]) if messages else cursor
+        if len(messages) < limit:
+            archived, has_more = archived_rows(room_id, older_than, limit - len(messages))
+            messages = archived + messages
+        else:
+            # A full page that empties the hot table may still have archived rows behind it
+            has_more = before_cursor(ArchivedMessage.objects.filter(room_id=room_id), older_than).exists()
+
+    next_before = encode_cursor(messages[0]) if has_more and messages else None
+    return messages, has_more, next_before
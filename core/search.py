@@ -0,0 +1,205 @@
+"""
+Full-text search over room messages.
+
+``CHAT_SEARCH_BACKEND`` names a SearchBackend subclass; the default keeps an
+SQLite FTS5 index. A backend provides:
+
+    install(connection)     create its index structures (idempotent)
+    uninstall(connection)
+    build(chunk_size)       index rows that existed before install, in chunks
+    search(room_ids, query, limit, offset)
+                            ranked hits as (message id, room id, snippet);
+                            the snippet is HTML with matches in <mark>
+
+SQLiteFTSBackend stores each message's text in ``core_message_fts`` under the
+message id. Triggers on the Message and ArchivedMessage tables keep it in
+sync, so every write path (create, bulk_create, write-behind batches,
+deletes) updates the index without Python involvement. Messages moved to
+the archive stay indexed, and only leave the index when deleted for good.
+SQLite drops a table's triggers when a migration rebuilds it, so they are
+recreated after every ``migrate`` once migration 0007 has installed them.
+"""
+import html
+import re
+from functools import lru_cache
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, transaction
+from django.db.migrations.recorder import MigrationRecorder
+from django.utils.module_loading import import_string
+from .models import ArchivedMessage, Message
+
+SEARCH_BACKEND = getattr(settings, 'CHAT_SEARCH_BACKEND', 'core.search.SQLiteFTSBackend')
+SEARCH_INDEX_CHUNK_SIZE = getattr(settings, 'CHAT_SEARCH_INDEX_CHUNK_SIZE', 5000)
+
+_TERM_RE = re.compile(r'\w+\*?', re.UNICODE)
+
+# Private use characters FTS5 puts around matches, replaced by <mark> tags
+# once the message text around them is escaped
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+
+
+class SearchBackend:
+    vendors = ()
+
+    def supports(self, connection):
+        return connection.vendor in self.vendors
+
+    def install(self, connection):
+        raise NotImplementedError
+
+    def uninstall(self, connection):
+        raise NotImplementedError
+
+    def build(self, chunk_size=SEARCH_INDEX_CHUNK_SIZE, progress=None):
+        raise NotImplementedError
+
+    def search(self, room_ids, query, limit, offset=0):
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    vendors = ('sqlite',)
+    table = 'core_message_fts'
+
+    def install(self, connection):
+        message = Message._meta.db_table
+        archived = ArchivedMessage._meta.db_table
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+            f"text, room_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')",
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_message_insert AFTER INSERT ON {message} BEGIN "
+            f"INSERT INTO {self.table} (rowid, text, room_id) VALUES (new.id, new.text, new.room_id); END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_message_update AFTER UPDATE OF text ON {message} BEGIN "
+            f"UPDATE {self.table} SET text = new.text WHERE rowid = new.id; END",
+            # Archiving copies a row, then deletes the hot one: keep it indexed
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_message_delete AFTER DELETE ON {message} BEGIN "
+            f"DELETE FROM {self.table} WHERE rowid = old.id "
+            f"AND NOT EXISTS (SELECT 1 FROM {archived} WHERE id = old.id); END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_archived_insert AFTER INSERT ON {archived} BEGIN "
+            f"INSERT INTO {self.table} (rowid, text, room_id) SELECT new.id, new.text, new.room_id "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {self.table} WHERE rowid = new.id); END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_archived_delete AFTER DELETE ON {archived} BEGIN "
+            f"DELETE FROM {self.table} WHERE rowid = old.id; END",
+        ]
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            for trigger in ('message_insert', 'message_update', 'message_delete', 'archived_insert', 'archived_delete'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {self.table}_{trigger}')
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+    def build(self, chunk_size=SEARCH_INDEX_CHUNK_SIZE, progress=None):
+        """Index rows missing from the index, one id range per transaction"""
+        self.install(connection)
+        indexed = 0
+        for model in (ArchivedMessage, Message):
+            source = model._meta.db_table
+            last_id = 0
+            while True:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(
+                        f'SELECT MAX(id) FROM (SELECT id FROM {source} WHERE id > %s ORDER BY id LIMIT %s)',
+                        [last_id, chunk_size],
+                    )
+                    upper = cursor.fetchone()[0]
+                    if upper is None:
+                        break
+                    cursor.execute(
+                        f'INSERT INTO {self.table} (rowid, text, room_id) '
+                        f'SELECT id, text, room_id FROM {source} WHERE id > %s AND id <= %s '
+                        f'AND id NOT IN (SELECT rowid FROM {self.table} WHERE rowid > %s AND rowid <= %s)',
+                        [last_id, upper, last_id, upper],
+                    )
+                    indexed += max(cursor.rowcount, 0)
+                last_id = upper
+                if progress is not None:
+                    progress(model, last_id, indexed)
+        return indexed
+
+    def search(self, room_ids, query, limit, offset=0):
+        match = fts_query(query)
+        if not match or not room_ids:
+            return []
+        placeholders = ', '.join(['%s'] * len(room_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, room_id, snippet({self.table}, 0, %s, %s, '…', 12) "
+                f'FROM {self.table} WHERE {self.table} MATCH %s AND room_id IN ({placeholders}) '
+                f'ORDER BY rank LIMIT %s OFFSET %s',
+                [MARK_START, MARK_END, match, *room_ids, limit, offset],
+            )
+            return [(pk, room_id, highlight(snippet)) for pk, room_id, snippet in cursor.fetchall()]
+
+
+def fts_query(query):
+    """
+    Turn user input into an FTS5 query: every word must match, a trailing
+    ``*`` makes it a prefix. Quoting each word keeps operators and column
+    filters typed by users from reaching the query parser.
+    """
+    terms = []
+    for term in _TERM_RE.findall(query or ''):
+        prefix = term.endswith('*')
+        word = term.rstrip('*')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return ' '.join(terms)
+
+
+def highlight(snippet):
+    """Escape a snippet marked with MARK_START/MARK_END and mark its matches"""
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    backend = import_string(SEARCH_BACKEND)()
+    if not backend.supports(connection):
+        raise ImproperlyConfigured(
+            f'{SEARCH_BACKEND} does not support the {connection.vendor} database backend'
+        )
+    return backend
+
+
+def reinstall_search_index(sender, using, **kwargs):
+    """post_migrate receiver: recreate index structures a migration dropped"""
+    connection = connections[using]
+    backend = import_string(SEARCH_BACKEND)()
+    if not backend.supports(connection):
+        return
+    # Not before 0007 installed it, nor after it was migrated back
+    if ('core', '0007_message_search') not in MigrationRecorder(connection).applied_migrations():
+        return
+    backend.install(connection)
+
+
+def search_messages(room_ids, query, limit, offset=0):
+    """
+    Return (hits, has_more) for ``query`` in the given rooms, best match first.
+    Each hit is the message (hot or archived, as a Message) with a
+    ``snippet`` attribute holding the highlighted match.
+    """
+    rows = get_search_backend().search(list(room_ids), query, limit + 1, offset)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    ids = [row[0] for row in rows]
+
+    messages = {m.pk: m for m in Message.objects.filter(pk__in=ids).select_related('user')}
+    missing = [pk for pk in ids if pk not in messages]
+    if missing:
+        for row in ArchivedMessage.objects.filter(pk__in=missing).select_related('user'):
+            messages[row.pk] = Message(id=row.pk, room_id=row.room_id, user=row.user, text=row.text,
+                                       created_at=row.created_at, seq=row.seq)
+
+    hits = []
+    for pk, _, snippet in rows:
+        message = messages.get(pk)
+        if message is not None:
+            message.snippet = snippet
+            hits.append(message)
+    return hits, has_more
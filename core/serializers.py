@@ -38,6 +38,15 @@ class AddUserSerializer(serializers.Serializer):
 
 
 
+class NotifyUsersSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False
+    )
+    data = serializers.JSONField()
+
+
+
 class MessageSerializer(serializers.ModelSerializer):
     created_at_formatted = serializers.SerializerMethodField()
     user = UserSerializer()
@@ -50,6 +59,45 @@ class MessageSerializer(serializers.ModelSerializer):
         return obj.created_at.strftime("%d-%m-%Y %H:%M:%S")
 
 
+class LastMessageSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ['id', 'text', 'user', 'username', 'created_at']
+
+
+class SearchHitSerializer(serializers.ModelSerializer):
+    """A search_messages() hit; ``snippet`` is escaped HTML highlighting matches with <mark>"""
+    username = serializers.CharField(source='user.username', read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ['id', 'room', 'seq', 'user', 'username', 'created_at', 'snippet']
+
+
+class RoomSummarySerializer(serializers.ModelSerializer):
+    """Slim room listing; expects Room.objects.with_summary() annotations"""
+    unread_count = serializers.IntegerField(read_only=True)
+    last_message = LastMessageSerializer(read_only=True)
+
+    class Meta:
+        model = Room
+        fields = [
+            "pk",
+            "name",
+            "creator",
+            "is_private",
+            "is_group",
+            "member_count",
+            "message_count",
+            "unread_count",
+            "last_activity_at",
+            "last_message",
+        ]
+
+
 class RoomSerializer(serializers.ModelSerializer):
     last_message = serializers.SerializerMethodField()
     messages = MessageSerializer(many=True, read_only=True)
@@ -76,6 +124,10 @@ class RoomSerializer(serializers.ModelSerializer):
         read_only_fields = ["messages", "last_message", "creator"]
 
     def get_last_message(self, obj:Room):
-        return MessageSerializer(obj.messages.order_by('created_at').last()).data
+        # Reuse prefetched messages instead of one query per room
+        if 'messages' in getattr(obj, '_prefetched_objects_cache', {}):
+            messages = obj.messages.all()
+            return MessageSerializer(messages[len(messages) - 1] if messages else None).data
+        return MessageSerializer(obj.last_message).data
     def create(self, validated_data):
         return Room.objects.create(**validated_data)
@@ -0,0 +1,16 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .middleware import token_cache
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_tokens(sender, instance, **kwargs):
+    """Deactivated, edited or deleted users must re-authenticate, on every worker"""
+    user_id = instance.pk
+    # After commit, so no worker re-caches the old row in between
+    transaction.on_commit(lambda: token_cache.publish_invalidation(user_id))
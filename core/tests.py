@@ -1,3 +1,515 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from unittest import mock
+from channels.exceptions import ChannelFull
+from django.apps import apps
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import connection
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from websocket_tut.asgi import application
+from .batching import BATCH_MAX_MESSAGES, BATCH_MAX_WINDOW, BATCH_MIN_WINDOW, FrameBatcher
+from .codecs import encode_frame
+from .counters import rebuild_room_counters, record_messages
+from .retention import archive_room_messages, room_history_rows, rows_after, rows_in_seq_range
+from .models import ArchivedMessage, Message, Room, RoomReadMarker, User
+from .history_cache import RoomHistoryCache
+from .layers import LocalChannelLayer
+from .middleware import VerifiedTokenCache
+from .outbound import OutboundQueueMixin
+from .ratelimit import RateLimiter
 
-# Create your tests here.
+
+class RoomListingQueryCountTests(TestCase):
+    """Room listings must cost the same number of queries however many rooms there are"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.other = User.objects.create_user('member', 'member@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.rooms = 0
+
+    def add_rooms(self, count, messages_per_room=3):
+        for _ in range(count):
+            self.rooms += 1
+            room = Room.objects.create(name=f'room {self.rooms}', creator=self.user, is_group=True)
+            room.current_users.add(self.user, self.other)
+            messages = [
+                Message.objects.create(room=room, user=self.other if n % 2 else self.user, text=f'message {n}')
+                for n in range(messages_per_room)
+            ]
+            record_messages(room.pk, messages)
+            RoomReadMarker.objects.create(room=room, user=self.user, last_read_message_id=messages[0].pk)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_room_summary_is_one_query(self):
+        self.add_rooms(2)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('room-summary'))
+        rooms = response.json()['rooms']
+        self.assertEqual(len(rooms), 2)
+        self.assertEqual(rooms[0]['unread_count'], 1)
+        self.assertEqual(rooms[0]['message_count'], 3)
+
+    def test_room_summary_query_count_does_not_grow(self):
+        self.add_rooms(2, messages_per_room=2)
+        few = self.count_queries(reverse('room-summary'))
+        self.add_rooms(10, messages_per_room=8)
+        self.assertEqual(self.count_queries(reverse('room-summary')), few)
+
+    def test_room_list_prefetches(self):
+        self.add_rooms(2, messages_per_room=2)
+        few = self.count_queries(reverse('room-list'))
+        self.add_rooms(10, messages_per_room=8)
+        # Rooms with their creator, then one prefetch each for members and messages
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('room-list'))
+        self.assertEqual(few, 3)
+        rooms = response.json()['rooms']
+        self.assertEqual(len(rooms), 12)
+        self.assertEqual(rooms[-1]['last_message']['text'], 'message 7')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class RoomMembershipCounterTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.guest = User.objects.create_user('guest', 'guest@example.com', 'password')
+        self.room = Room.objects.create(name='room', creator=self.owner, is_group=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_member_count_counts_each_user_once(self):
+        url = reverse('add-user-to-room', args=[self.room.pk])
+        for _ in range(2):
+            response = self.client.patch(url, {'user_ids': [self.guest.pk]}, format='json')
+            self.assertEqual(response.status_code, 200)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.member_count, 1)
+
+        url = reverse('remove-users-from-room', args=[self.room.pk])
+        for _ in range(2):
+            self.client.patch(url, {'user_ids': [self.guest.pk]}, format='json')
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.member_count, 0)
+
+    def test_only_new_members_are_notified(self):
+        self.room.current_users.add(self.guest)
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        url = reverse('add-user-to-room', args=[self.room.pk])
+        with mock.patch('core.views.notify_membership_changed') as membership_changed, \
+                mock.patch('core.views.notify_users') as notify_users:
+            self.client.patch(url, {'user_ids': [self.guest.pk, other.pk]}, format='json')
+            self.client.patch(url, {'user_ids': [self.guest.pk]}, format='json')
+        membership_changed.assert_called_once_with(self.room.pk, added=[other.pk])
+        self.assertEqual([c.args[0] for c in notify_users.call_args_list], [[other.pk], []])
+
+
+class ArchivedHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.room = Room.objects.create(name='room', creator=self.user, is_group=True)
+        messages = [Message.objects.create(room=self.room, user=self.user, text=f'message {n}') for n in range(60)]
+        record_messages(self.room.pk, messages)
+        self.room.refresh_from_db()
+        self.assertEqual(archive_room_messages(self.room, messages[10].created_at), 10)
+
+    def test_full_hot_page_continues_into_archive(self):
+        messages, has_more, next_before = room_history_rows(self.room.pk, None, 50)
+        self.assertEqual(len(messages), 50)
+        self.assertTrue(has_more)
+        older, has_more, _ = room_history_rows(self.room.pk, next_before, 50)
+        self.assertEqual([m.text for m in older], [f'message {n}' for n in range(10)])
+        self.assertFalse(has_more)
+
+    def test_replay_reads_archived_sequence_numbers(self):
+        messages, has_more = rows_in_seq_range(self.room.pk, 5, 15)
+        self.assertEqual([m.seq for m in messages], list(range(6, 16)))
+        self.assertFalse(has_more)
+        messages, has_more = rows_in_seq_range(self.room.pk, 0, limit=8)
+        self.assertEqual([m.seq for m in messages], list(range(1, 9)))
+        self.assertTrue(has_more)
+
+    def test_message_count_includes_archived_messages(self):
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 60)
+        rebuild_room_counters()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 60)
+
+
+class RecordingConnection(OutboundQueueMixin):
+    """Outbound queue over a server send that never pushes back, like daphne's"""
+    outbound_acks = True
+    outbound_unacked_limit = 4
+
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def base_send(self, message):
+        self.sent.append(message.get('text'))
+
+    async def _close_now(self, code, reason):
+        self.closed = code
+
+
+class UnackedBacklogTests(SimpleTestCase):
+    async def send_frames(self, connection, count):
+        for n in range(count):
+            await connection.send(text_data=json.dumps({'n': n}))
+            await asyncio.sleep(0)
+
+    async def test_resync_when_client_stops_acking(self):
+        connection = RecordingConnection()
+        await self.send_frames(connection, 8)
+        # Five frames pushed the backlog over four; the marker follows them
+        self.assertEqual(len(connection.sent), 6)
+        self.assertEqual(json.loads(connection.sent[-1]), {'type': 'resync_required'})
+
+        connection.acknowledge_outbound(5)
+        await self.send_frames(connection, 1)
+        self.assertEqual(len(connection.sent), 6)
+
+        connection.acknowledge_outbound(6)
+        await self.send_frames(connection, 1)
+        self.assertEqual(len(connection.sent), 7)
+
+    async def test_acked_frames_do_not_count(self):
+        connection = RecordingConnection()
+        for _ in range(5):
+            await self.send_frames(connection, 3)
+            connection.acknowledge_outbound(len(connection.sent))
+        self.assertEqual(len(connection.sent), 15)
+        self.assertIsNone(connection.closed)
+
+    async def test_connections_that_never_ack_are_bounded(self):
+        connection = RecordingConnection()
+        connection.outbound_acks = False
+        connection.scope = {'query_string': b''}
+        connection.negotiate_outbound_acks()
+        await self.send_frames(connection, 8)
+        self.assertEqual(json.loads(connection.sent[-1]), {'type': 'resync_required'})
+
+        connection.outbound_require_acks = False
+        connection.negotiate_outbound_acks()
+        self.assertFalse(connection.outbound_acks)
+
+    async def test_disconnect_policy(self):
+        connection = RecordingConnection()
+        connection.outbound_policy = 'disconnect'
+        await self.send_frames(connection, 8)
+        self.assertEqual(len(connection.sent), 5)
+        self.assertEqual(connection.closed, 4008)
+
+
+class MessageSequenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.room = Room.objects.create(name='room', creator=self.user, is_group=True)
+
+    def test_numbers_are_not_reused_after_delete(self):
+        messages = [Message.objects.create(room=self.room, user=self.user, text=str(n)) for n in range(3)]
+        self.assertEqual([m.seq for m in messages], [1, 2, 3])
+        messages[-1].delete()
+        rebuild_room_counters()
+        self.assertEqual(Message.objects.create(room=self.room, user=self.user, text='next').seq, 4)
+
+    def test_numbering_is_one_statement(self):
+        with CaptureQueriesContext(connection) as queries:
+            message = Message.objects.create(room=self.room, user=self.user, text='first')
+        statements = [q['sql'] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(len(statements), 2)
+        self.assertIn('RETURNING', statements[0])
+        self.assertEqual(message.seq, 1)
+        self.assertEqual(Room.objects.reserve_seq(self.room.pk, 3), 2)
+        with self.assertRaises(Room.DoesNotExist):
+            Room.objects.reserve_seq(0)
+
+
+class RoomHistoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = RoomHistoryCache(size=10)
+        self.cache.connected(1)
+        token = self.cache.prime_token(1)
+        self.cache.prime(1, [{'id': n, 'seq': n} for n in range(1, 4)], False, token)
+
+    def test_appends_next_sequence_number(self):
+        self.cache.append(1, {'id': 4, 'seq': 4})
+        messages, has_more, _ = self.cache.page(1, 10)
+        self.assertEqual([m['seq'] for m in messages], [1, 2, 3, 4])
+        self.assertFalse(has_more)
+
+    def test_sequence_gap_drops_room(self):
+        # seq 4 went to another worker's write and was never delivered here
+        self.cache.append(1, {'id': 5, 'seq': 5})
+        self.assertIsNone(self.cache.page(1, 10))
+
+
+class VerifiedTokenCacheTests(SimpleTestCase):
+    async def test_concurrent_misses_share_one_lookup(self):
+        cache = VerifiedTokenCache()
+        lookups = []
+
+        async def loader(token):
+            lookups.append(token)
+            await asyncio.sleep(0.01)
+            return User(pk=1, username='owner')
+
+        users = await asyncio.gather(*(cache.load('token', loader) for _ in range(5)))
+        self.assertEqual(lookups, ['token'])
+        self.assertEqual({user.pk for user in users}, {1})
+        self.assertEqual(len({id(user) for user in users}), 5)
+        await cache.load('token', loader)
+        self.assertEqual(len(lookups), 2)
+
+
+class LocalChannelLayerTests(SimpleTestCase):
+    async def test_full_channel(self):
+        layer = LocalChannelLayer(capacity=2)
+        for n in range(2):
+            await layer.send('reader', {'n': n})
+        with self.assertRaises(ChannelFull):
+            await layer.send('reader', {'n': 2})
+
+        # A group member that is full just misses the event
+        await layer.group_add('room', 'reader')
+        await layer.group_add('room', 'other')
+        await layer.group_send('room', {'n': 3})
+        self.assertEqual([(await layer.receive('reader'))['n'] for _ in range(2)], [0, 1])
+        self.assertEqual((await layer.receive('other'))['n'], 3)
+
+    async def test_expired_messages_are_skipped_and_free_capacity(self):
+        layer = LocalChannelLayer(expiry=0.05, capacity=1)
+        await layer.send('reader', {'n': 0})
+        await asyncio.sleep(0.1)
+        await layer.send('reader', {'n': 1})
+        self.assertEqual((await layer.receive('reader'))['n'], 1)
+
+    async def test_group_membership_expires(self):
+        layer = LocalChannelLayer(group_expiry=0.05)
+        await layer.group_add('room', 'stale')
+        await asyncio.sleep(0.1)
+        await layer.group_add('room', 'fresh')
+        await layer.group_send('room', {'n': 0})
+        self.assertEqual(list(layer.groups['room']), ['fresh'])
+        self.assertNotIn('stale', layer.channels)
+
+    async def test_receive_waits_for_send(self):
+        layer = LocalChannelLayer()
+        receiving = asyncio.ensure_future(layer.receive('reader'))
+        await asyncio.sleep(0)
+        await layer.group_add('room', 'reader')
+        await layer.group_send('room', {'n': 0})
+        self.assertEqual((await asyncio.wait_for(receiving, 1))['n'], 0)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        clock = mock.patch('core.ratelimit.time')
+        self.time = clock.start()
+        self.addCleanup(clock.stop)
+        self.time.monotonic.return_value = 100.0
+        self.limiter = RateLimiter({'chat_message': {'user': (2, 3), 'room': (1, 5)}})
+
+    def test_burst_then_retry_after(self):
+        self.assertEqual([self.limiter.check('chat_message', 1, 9) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.limiter.check('chat_message', 1, 9), 0.5)
+        # Another user has their own bucket but shares the room's
+        self.assertEqual(self.limiter.check('chat_message', 2, 9), 0)
+        self.time.monotonic.return_value = 100.5
+        self.assertEqual(self.limiter.check('chat_message', 1, 9), 0)
+
+    def test_refused_check_takes_no_tokens(self):
+        for user_id in range(5):
+            self.assertEqual(self.limiter.check('chat_message', user_id, 9), 0)
+        self.assertAlmostEqual(self.limiter.check('chat_message', 5, 9), 1.0)
+        # The user's bucket was not charged for the refused message
+        for _ in range(3):
+            self.assertEqual(self.limiter.check('chat_message', 5, None), 0)
+        self.assertTrue(self.limiter.check('chat_message', 5, None))
+
+    def test_unlimited_actions_pass(self):
+        self.assertEqual(self.limiter.check('typing', 1, 9), 0)
+        self.assertEqual(self.limiter.check(None, 1, 9), 0)
+
+    def test_usage_from_other_workers_is_debited(self):
+        self.limiter.apply_usage([['chat_message', 'user', '1', 10]])
+        # Owes at most one burst (-3), so the next token is 2 seconds away
+        self.assertAlmostEqual(self.limiter.check('chat_message', 1, None), 2.0)
+
+
+class RecordingConsumer:
+    use_msgpack = False
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_encoded(self, frame):
+        self.sent.append(json.loads(frame['text']))
+
+
+class FrameBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = RecordingConsumer()
+        self.batcher = FrameBatcher(self.consumer)
+
+    def busy(self, messages_per_second):
+        self.batcher.avg_gap = 1 / messages_per_second
+        self.batcher.last_at = asyncio.get_running_loop().time()
+
+    def frame(self, n):
+        return encode_frame({'type': 'chat_message', 'n': n})
+
+    def test_window_follows_rate(self):
+        self.assertEqual(self.batcher.window(), 0)
+        self.batcher.avg_gap = 1
+        self.assertEqual(self.batcher.window(), 0)
+        self.batcher.avg_gap = 1 / 20
+        self.assertAlmostEqual(self.batcher.window(), BATCH_MIN_WINDOW)
+        self.batcher.avg_gap = 1 / 1000
+        self.assertAlmostEqual(self.batcher.window(), BATCH_MAX_WINDOW)
+
+    async def test_quiet_room_sends_at_once(self):
+        await self.batcher.add(self.frame(0))
+        self.assertEqual(self.consumer.sent, [{'type': 'chat_message', 'n': 0}])
+
+    async def test_busy_room_batches_in_order(self):
+        self.busy(1000)
+        for n in range(3):
+            await self.batcher.add(self.frame(n))
+        self.assertEqual(self.consumer.sent, [])
+        await asyncio.sleep(BATCH_MAX_WINDOW * 2)
+        self.assertEqual(len(self.consumer.sent), 1)
+        batch = self.consumer.sent[0]
+        self.assertEqual(batch['type'], 'chat_messages')
+        self.assertEqual([m['n'] for m in batch['messages']], [0, 1, 2])
+
+    async def test_full_batch_goes_out_without_waiting(self):
+        self.busy(1000)
+        for n in range(BATCH_MAX_MESSAGES):
+            await self.batcher.add(self.frame(n))
+        self.assertEqual(len(self.consumer.sent[0]['messages']), BATCH_MAX_MESSAGES)
+        self.assertIsNone(self.batcher._handle)
+
+    async def test_flush_sends_held_frames_first(self):
+        self.busy(1000)
+        await self.batcher.add(self.frame(0))
+        await self.batcher.add(self.frame(1))
+        # message_persisted flushes the batch before going out
+        await self.batcher.flush()
+        await self.consumer.send_encoded(encode_frame({'type': 'message_persisted'}))
+        self.assertEqual([f['type'] for f in self.consumer.sent], ['chat_messages', 'message_persisted'])
+        await asyncio.sleep(BATCH_MAX_WINDOW * 2)
+        self.assertEqual(len(self.consumer.sent), 2)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class SyncTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.room = Room.objects.create(name='room', creator=self.user, is_group=True)
+        self.messages = [Message.objects.create(room=self.room, user=self.user, text=f'message {n}') for n in range(5)]
+        record_messages(self.room.pk, self.messages)
+        self.token = str(AccessToken.for_user(self.user))
+
+    async def connect(self, query=''):
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.room.pk}/?token={self.token}&{query}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_since_sends_only_newer_messages(self):
+        communicator = await self.connect(f'since={self.messages[2].pk}')
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'message_sync')
+        self.assertEqual([m['text'] for m in frame['messages']], ['message 3', 'message 4'])
+
+        await communicator.send_json_to({'type': 'sync', 'since': self.messages[3].pk})
+        frame = await communicator.receive_json_from()
+        self.assertEqual([m['text'] for m in frame['messages']], ['message 4'])
+        await communicator.disconnect()
+
+    async def test_too_far_behind_resyncs(self):
+        with mock.patch('core.consumers.SYNC_MAX_MESSAGES', 1):
+            communicator = await self.connect(f'since={self.messages[2].pk}')
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'resync_required', 'reason': 'too_far_behind'})
+            frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'message_history')
+        self.assertEqual(len(frame['messages']), 5)
+        await communicator.disconnect()
+
+    async def test_unparsable_since_loads_history(self):
+        communicator = await self.connect('since=\u00b2')
+        self.assertEqual((await communicator.receive_json_from())['type'], 'message_history')
+        await communicator.disconnect()
+
+    def test_archived_gap_is_too_old(self):
+        self.assertEqual([m.pk for m in rows_after(self.room.pk, self.messages[2].pk, 10)], [m.pk for m in self.messages[3:]])
+        self.assertIsNone(rows_after(self.room.pk, self.messages[0].pk, 1))
+        archive_room_messages(self.room, self.messages[2].created_at)
+        self.assertIsNone(rows_after(self.room.pk, self.messages[0].pk, 10))
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.room = Room.objects.create(name='room', creator=self.user, is_group=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, q, **params):
+        response = self.client.get(reverse('search'), {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_only_the_users_rooms_are_searched(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        private = Room.objects.create(name='private', creator=other, is_group=True)
+        Message.objects.create(room=self.room, user=self.user, text='lunch at noon')
+        Message.objects.create(room=private, user=other, text='lunch without owner')
+        self.assertEqual([hit['room'] for hit in self.search('lunch')], [self.room.pk])
+        self.assertEqual(self.search('lunch', room=private.pk), [])
+
+    def test_best_match_first(self):
+        weak = Message.objects.create(room=self.room, user=self.user, text='release notes for the next meeting agenda')
+        strong = Message.objects.create(room=self.room, user=self.user, text='release release release')
+        self.assertEqual([hit['id'] for hit in self.search('release')], [strong.pk, weak.pk])
+        self.assertEqual([hit['id'] for hit in self.search('release meeting')], [weak.pk])
+
+    def test_index_follows_archive_and_delete(self):
+        message = Message.objects.create(room=self.room, user=self.user, text='quarterly report')
+        self.assertEqual([hit['id'] for hit in self.search('quarterly')], [message.pk])
+        archive_room_messages(self.room, message.created_at + timedelta(seconds=1))
+        self.assertFalse(Message.objects.filter(pk=message.pk).exists())
+        self.assertEqual([hit['id'] for hit in self.search('quarterly')], [message.pk])
+        ArchivedMessage.objects.filter(pk=message.pk).delete()
+        self.assertEqual(self.search('quarterly'), [])
+
+        message = Message.objects.create(room=self.room, user=self.user, text='weekly report')
+        message.delete()
+        self.assertEqual(self.search('report'), [])
+
+    def test_snippet_is_escaped(self):
+        Message.objects.create(room=self.room, user=self.user, text='hello <img src=x onerror=alert(1)> world')
+        [hit] = self.search('img')
+        self.assertEqual(hit['snippet'], 'hello &lt;<mark>img</mark> src=x onerror=alert(1)&gt; world')
+
+    def test_migrate_recreates_dropped_triggers(self):
+        # What SQLite does to the triggers when a migration rebuilds core_message
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER core_message_fts_message_insert')
+        emit_post_migrate_signal(0, False, 'default', apps=apps)
+        Message.objects.create(room=self.room, user=self.user, text='after rebuild')
+        self.assertEqual(len(self.search('rebuild')), 1)
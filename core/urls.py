@@ -5,6 +5,11 @@ urlpatterns = [
     path('user-list', views.get_users, name='user-list'),
     path('create-room', views.create_room, name='create-room'),
     path('room-list', views.room_list, name='room-list'),
+    path('room-summary', views.room_summary, name='room-summary'),
+    path('mark-room-read/<int:pk>', views.mark_room_read, name='mark-room-read'),
+    path('room-replay/<int:pk>', views.room_replay, name='room-replay'),
+    path('search', views.search, name='search'),
     path('add-user-to-room/<int:pk>', views.add_user_to_room, name='add-user-to-room'),
     path('remove-users-from-room/<int:pk>', views.remove_user_from_room, name='remove-users-from-room'),
+    path('notify', views.notify, name='notify'),
 ]
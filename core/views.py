@@ -1,12 +1,20 @@
 from django.shortcuts import render, get_object_or_404, reverse
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from .serializers import UserSerializer, RoomSerializer, AddUserSerializer, MessageSerializer
-from .models import Room, User, Message
-from rest_framework.permissions import IsAuthenticated
+from .serializers import UserSerializer, RoomSerializer, AddUserSerializer, MessageSerializer, NotifyUsersSerializer, RoomSummarySerializer, SearchHitSerializer
+from .models import Room, User, Message, RoomReadMarker
+from django.db import transaction
+from django.db.models import F, Prefetch
+from .counters import adjust_member_count
+from .retention import rows_in_seq_range
+from .search import search_messages
+from .pagination import clamp_limit
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from drf_spectacular.utils import extend_schema, OpenApiExample, OpenApiTypes, OpenApiParameter
 from rest_framework.parsers import JSONParser
+from .broadcast import notify_membership_changed, notify_users
+from .metrics import registry
 
 
 @extend_schema(
@@ -67,8 +75,11 @@ def create_room(request):
 
     serializer = RoomSerializer(data=data)
     if serializer.is_valid():
-        room = serializer.save(creator=request.user)
-        room.current_users.add(request.user)
+        with transaction.atomic():
+            room = serializer.save(creator=request.user)
+            room.current_users.add(request.user)
+            adjust_member_count(room.pk, 1)
+        room.refresh_from_db(fields=['member_count'])
 
         return Response({
             'message': 'Room created',
@@ -86,7 +97,12 @@ def create_room(request):
 @permission_classes([IsAuthenticated])
 def room_list(request):
     try:
-        rooms = Room.objects.filter(creator = request.user)                
+        rooms = (Room.objects.filter(creator = request.user)
+                 .select_related('creator')
+                 .prefetch_related(
+                     'current_users',
+                     Prefetch('messages', queryset=Message.objects.select_related('user').order_by('created_at'))
+                 ))
     except Room.DoesNotExist:
         return JsonResponse({
             'status':'error'
@@ -100,6 +116,126 @@ def room_list(request):
 
 
 
+@extend_schema(responses=RoomSummarySerializer(many=True))
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def room_summary(request):
+    """Rooms the user belongs to with member count, unread count and last message"""
+    rooms = (Room.objects.for_user(request.user)
+             .with_summary(request.user)
+             .order_by(F('last_activity_at').desc(nulls_last=True), '-pk'))
+
+    serializer = RoomSummarySerializer(rooms, many=True)
+    return Response({
+        'status': 'success',
+        'rooms': serializer.data
+    })
+
+
+@api_view(['PATCH'])
+@permission_classes([IsAuthenticated])
+def mark_room_read(request, pk):
+    """Move the user's read marker to the given or newest message of a room"""
+    room = get_object_or_404(Room.objects.for_user(request.user), pk=pk)
+
+    message_id = request.data.get('message_id')
+    if message_id is None:
+        message_id = (Message.objects.filter(room=room)
+                      .order_by('-created_at', '-pk')
+                      .values_list('pk', flat=True).first()) or 0
+    try:
+        message_id = int(message_id)
+    except (TypeError, ValueError):
+        return Response({
+            'message': 'message_id must be an integer',
+            'status': 'error'
+        }, status=400)
+
+    RoomReadMarker.objects.update_or_create(
+        room=room, user=request.user,
+        defaults={'last_read_message_id': message_id}
+    )
+    return Response({
+        'message': 'Room marked as read',
+        'last_read_message_id': message_id,
+        'status': 'success'
+    }, status=200)
+
+
+@extend_schema(
+    responses=SearchHitSerializer(many=True),
+    parameters=[
+        OpenApiParameter('q', OpenApiTypes.STR, required=True, description='Words to find; end one with * for a prefix'),
+        OpenApiParameter('room', OpenApiTypes.INT, description='Only search this room'),
+        OpenApiParameter('limit', OpenApiTypes.INT),
+        OpenApiParameter('offset', OpenApiTypes.INT),
+    ]
+)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search(request):
+    """Messages of the user's rooms matching q, best match first"""
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({
+            'message': 'q is required',
+            'status': 'error'
+        }, status=400)
+    try:
+        limit = clamp_limit(request.query_params.get('limit'))
+        offset = max(0, int(request.query_params.get('offset', 0)))
+        room_id = request.query_params.get('room')
+        room_id = int(room_id) if room_id is not None else None
+    except ValueError:
+        return Response({
+            'message': 'room, limit and offset must be integers',
+            'status': 'error'
+        }, status=400)
+
+    rooms = Room.objects.for_user(request.user)
+    if room_id is not None:
+        rooms = rooms.filter(pk=room_id)
+    hits, has_more = search_messages(rooms.values_list('pk', flat=True), query, limit, offset)
+    return Response({
+        'status': 'success',
+        'results': SearchHitSerializer(hits, many=True).data,
+        'has_more': has_more,
+        'next_offset': offset + limit if has_more else None
+    })
+
+
+@extend_schema(
+    responses=MessageSerializer(many=True),
+    parameters=[
+        OpenApiParameter('after_seq', OpenApiTypes.INT, required=True,
+                         description='Last sequence number the client has'),
+        OpenApiParameter('until_seq', OpenApiTypes.INT,
+                         description='Last sequence number wanted (inclusive)'),
+    ]
+)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def room_replay(request, pk):
+    """Messages of a sequence gap, at most CHAT_REPLAY_MAX_MESSAGES per call"""
+    room = get_object_or_404(Room.objects.for_user(request.user), pk=pk)
+    try:
+        after_seq = int(request.query_params['after_seq'])
+        until_seq = request.query_params.get('until_seq')
+        until_seq = int(until_seq) if until_seq is not None else None
+    except (KeyError, ValueError):
+        return Response({
+            'message': 'after_seq (and until_seq if given) must be integers',
+            'status': 'error'
+        }, status=400)
+
+    messages, has_more = rows_in_seq_range(room.pk, after_seq, until_seq)
+    return Response({
+        'status': 'success',
+        'messages': MessageSerializer(messages, many=True).data,
+        'has_more': has_more
+    })
+
+
 @extend_schema(
     request=RoomSerializer,
     responses=RoomSerializer,
@@ -138,24 +274,33 @@ def add_user_to_room(request, pk):
             'status': 'unauthorized'
         }, status=403)
 
-    # Count current users
-    current_user_count = room.current_users.count()
-
     # Filter users to add (to avoid invalid IDs)
-    users_to_add = User.objects.filter(pk__in=user_ids)
+    users_to_add = list(User.objects.filter(pk__in=user_ids))
 
-    # Calculate total if we add these new users (exclude duplicates)
-    new_unique_users_count = users_to_add.exclude(pk__in=room.current_users.values_list('pk', flat=True)).count()
-    total_after_add = current_user_count + new_unique_users_count
+    with transaction.atomic():
+        # Lock the room (SQLite: the IMMEDIATE transaction) so concurrent
+        # adds see each other's members and count each new user once
+        room = Room.objects.select_for_update().get(pk=room.pk)
+        member_ids = set(room.current_users.values_list('pk', flat=True))
+        new_users = [user for user in users_to_add if user.pk not in member_ids]
 
-    if room.is_private and not room.is_group and total_after_add > 2:
-        return Response({
-            'message': 'Private one-to-one room cannot have more than 2 users.',
-            'status': 'error'
-        }, status=400)
+        if room.is_private and not room.is_group and len(member_ids) + len(new_users) > 2:
+            return Response({
+                'message': 'Private one-to-one room cannot have more than 2 users.',
+                'status': 'error'
+            }, status=400)
 
-    # Add users only after validation passed
-    room.current_users.add(*users_to_add)
+        # Add users only after validation passed
+        room.current_users.add(*new_users)
+        adjust_member_count(room.pk, len(new_users))
+    # Users who already were members keep their connections as they are
+    if new_users:
+        notify_membership_changed(room.pk, added=[u.pk for u in new_users])
+    notify_users([u.pk for u in new_users], {
+        'event': 'added_to_room',
+        'room_id': room.pk,
+        'room_name': room.name,
+    })
 
     return Response({
         'message': f"Added users {', '.join([u.username for u in users_to_add])} to the room",
@@ -198,14 +343,71 @@ def remove_user_from_room(request, pk):
         }, status=403)
 
     user_ids = serializer.validated_data.get('user_ids', [])
-    users_to_remove = room.current_users.filter(pk__in=user_ids)
-    users_in_room_ids = set(room.current_users.values_list('pk', flat=True))
-    not_in_room = list(set(user_ids) - users_in_room_ids)
 
-    room.current_users.remove(*users_to_remove)
+    with transaction.atomic():
+        # Same lock as add_user_to_room: count only members still present
+        room = Room.objects.select_for_update().get(pk=room.pk)
+        users_to_remove = list(room.current_users.filter(pk__in=user_ids))
+        users_in_room_ids = set(room.current_users.values_list('pk', flat=True))
+        room.current_users.remove(*users_to_remove)
+        adjust_member_count(room.pk, -len(users_to_remove))
+    not_in_room = list(set(user_ids) - users_in_room_ids)
+    notify_membership_changed(room.pk, removed=[u.pk for u in users_to_remove])
+    notify_users([u.pk for u in users_to_remove], {
+        'event': 'removed_from_room',
+        'room_id': room.pk,
+        'room_name': room.name,
+    })
 
     return Response({
         'message': f"Removed users {', '.join([u.username for u in users_to_remove])} from the room",
         'not_in_room': not_in_room,
         'status': 'success'
     }, status=200)
+
+
+@extend_schema(
+    request=NotifyUsersSerializer,
+    examples=[
+        OpenApiExample(
+            name="Notify users",
+            value={
+                "user_ids": [1, 2, 3],
+                "data": {"event": "announcement", "text": "Maintenance at 10pm"},
+            }
+        )
+    ]
+)
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def notify(request):
+    serializer = NotifyUsersSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({
+            'message': 'Validation failed',
+            'errors': serializer.errors,
+            'status': 'error'
+        }, status=400)
+
+    user_ids = list(dict.fromkeys(serializer.validated_data['user_ids']))
+    notified = notify_users(user_ids, serializer.validated_data['data'])
+
+    return Response({
+        'message': f'Notified {notified} users',
+        'status': 'success'
+    }, status=200)
+
+
+@extend_schema(exclude=True)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """
+    Prometheus scrape endpoint for this worker's metrics. Staff only: the
+    output names rooms and their connection counts, so scrape it with a
+    staff user's access token (Prometheus ``authorization`` config).
+    """
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
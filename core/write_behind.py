@@ -0,0 +1,159 @@
+"""
+Optional write-behind persistence for chat messages.
+
+When ``CHAT_WRITE_BEHIND_ENABLED`` is set, ChatConsumer broadcasts a new
+message straight away under a provisional id and hands the unsaved row to
+this queue. Rows are written with one ``bulk_create`` per batch and a
+``message_persisted`` event tells the room which real id each provisional id
+got. Messages that could not be written are listed under ``failed`` in the
+same event, so clients can retract (or offer to resend) what they already
+showed:
+
+    {"type": "message_persisted", "messages": [{"provisional_id": ..., "id": ...,
+     "seq": ..., "created_at": ...}], "failed": ["p-..."]}
+
+Flush semantics:
+    * a batch is written as soon as ``CHAT_WRITE_BEHIND_BATCH_SIZE`` rows are
+      queued, or ``CHAT_WRITE_BEHIND_FLUSH_INTERVAL`` seconds after the first
+      queued row, whichever happens first;
+    * ChatConsumer.disconnect awaits ``flush()`` so a closing connection never
+      leaves its own messages behind;
+    * on interpreter shutdown an ``atexit`` hook writes whatever is still
+      queued synchronously. Messages are only lost if the process is killed
+      without running exit handlers (SIGKILL, OOM).
+"""
+import asyncio
+import atexit
+import logging
+import uuid
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from .broadcast import room_group_name
+from .codecs import encode_frame
+from .counters import assign_sequences, record_messages
+from .db import db_write
+from .metrics import DB_CALL_SECONDS, GROUP_SEND_SECONDS
+from .history_cache import history_cache
+from .models import Message
+from .serializers import MessageSerializer
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = getattr(settings, 'CHAT_WRITE_BEHIND_ENABLED', False)
+WRITE_BEHIND_BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100)
+WRITE_BEHIND_FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.05)
+
+
+def new_provisional_id():
+    return f'p-{uuid.uuid4().hex}'
+
+
+class MessageWriteBehind:
+    """Per-worker queue of unsaved messages flushed with bulk_create"""
+
+    def __init__(self, batch_size=WRITE_BEHIND_BATCH_SIZE, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    async def enqueue(self, message):
+        """Queue an unsaved Message carrying a ``provisional_id`` attribute"""
+        self.pending.append(message)
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Write every queued message and acknowledge it to its room"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            with DB_CALL_SECONDS.time(call='write_behind_flush'):
+                saved = await db_write(self.write)(batch)
+        saved_ids = {id(message) for message in saved}
+        failed = [message for message in batch if id(message) not in saved_ids]
+        await self.acknowledge(saved, failed)
+
+    def flush_sync(self):
+        """Write whatever is queued without an event loop (used at exit)"""
+        batch, self.pending = self.pending, []
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        """Persist a batch, falling back to row-by-row inserts on failure"""
+        try:
+            with transaction.atomic():
+                assign_sequences(batch)
+                Message.objects.bulk_create(batch)
+                self.record(batch)
+            return batch
+        except Exception:
+            logger.exception('Batched insert of %d messages failed, retrying one by one', len(batch))
+
+        saved = []
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    # Numbered by the insert itself this time
+                    message.seq = None
+                    message.save(force_insert=True)
+                    record_messages(message.room_id, [message])
+                saved.append(message)
+            except Exception:
+                logger.exception('Dropping message %s for room %s', message.provisional_id, message.room_id)
+        return saved
+
+    def record(self, batch):
+        """Update the denormalized room columns once per room in the batch"""
+        by_room = {}
+        for message in batch:
+            by_room.setdefault(message.room_id, []).append(message)
+        for room_id, messages in by_room.items():
+            record_messages(room_id, messages)
+
+    async def acknowledge(self, saved, failed=()):
+        """Send one message_persisted event per room for a written batch"""
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        by_room = {}
+        for message in saved:
+            by_room.setdefault(message.room_id, ([], []))[0].append(message)
+        for message in failed:
+            by_room.setdefault(message.room_id, ([], []))[1].append(message)
+        for room_id, (messages, dropped) in by_room.items():
+            frame = {
+                'type': 'message_persisted',
+                'messages': [{
+                    'provisional_id': message.provisional_id,
+                    'id': message.pk,
+                    'seq': message.seq,
+                    'created_at': message.created_at.isoformat(),
+                } for message in messages]
+            }
+            if dropped:
+                frame['failed'] = [message.provisional_id for message in dropped]
+            event = {'type': 'message_persisted', **encode_frame(frame)}
+            if history_cache.enabled:
+                # Receiving workers append the persisted rows to their cache
+                event['message_data'] = MessageSerializer(messages, many=True).data
+            with GROUP_SEND_SECONDS.time(event='message_persisted'):
+                await channel_layer.group_send(room_group_name(room_id), event)
+
+
+write_behind = MessageWriteBehind()
+atexit.register(write_behind.flush_sync)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -119,17 +120,143 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Database pool threads keep their connection between calls
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            # Take the write lock when a transaction starts, so it waits out
+            # busy_timeout instead of failing when it upgrades from a read
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+# 'redis' for multi-process deployments, 'local' for a single process
+# (see core/layers.py)
+CHAT_CHANNEL_LAYER = os.environ.get('CHAT_CHANNEL_LAYER', 'redis')
+
+if CHAT_CHANNEL_LAYER == 'local':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "core.layers.LocalChannelLayer",
+            "CONFIG": {
+                "capacity": 1000,
+                "expiry": 60,
+            },
         },
-    },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [("127.0.0.1", 6379)],
+            },
+        },
+    }
+
+# Write-behind persistence of chat messages (see core/write_behind.py)
+CHAT_WRITE_BEHIND_ENABLED = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.05  # seconds
+
+# Per-worker cache of the newest messages of each room (see core/history_cache.py)
+CHAT_HISTORY_CACHE_SIZE = 100  # messages per room, 0 disables the cache
+CHAT_HISTORY_CACHE_MAX_ROOMS = 1000
+CHAT_HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Reconnecting clients pass ?since=<last message id> (or send a sync frame);
+# beyond this many missed messages they get resync_required instead
+CHAT_SYNC_MAX_MESSAGES = 200
+
+# Messages carry a per-room seq; a client that sees a gap asks for the
+# missing range (replay frame or room-replay endpoint), at most this many
+CHAT_REPLAY_MAX_MESSAGES = 200
+
+# Full-text message search (see core/search.py). After migrating, index the
+# existing messages once with `manage.py build_search_index`.
+CHAT_SEARCH_BACKEND = 'core.search.SQLiteFTSBackend'
+CHAT_SEARCH_INDEX_CHUNK_SIZE = 5000
+
+# Frames larger than this are zlib compressed for clients that negotiated
+# the json.zlib or msgpack.zlib subprotocol (see core/codecs.py)
+CHAT_COMPRESSION_THRESHOLD = 16 * 1024  # bytes
+CHAT_COMPRESSION_LEVEL = 6
+
+# Per-worker cache of verified WebSocket access tokens (see core/middleware.py).
+# User saves and deletes clear it on every worker through the channel layer;
+# QuerySet.update() sends no signal and is only seen once entries expire.
+CHAT_TOKEN_CACHE_SIZE = 10000
+CHAT_TOKEN_CACHE_TTL = 300  # seconds, capped by the token's exp
+
+# Concurrent group sends per batch when notifying many users at once
+CHAT_NOTIFY_BATCH_SIZE = 500
+
+# Days messages stay in the hot Message table before `manage.py
+# archive_messages` moves them to the archive; None keeps them forever.
+# Rooms can override it with Room.retention_days (see core/retention.py)
+CHAT_MESSAGE_RETENTION_DAYS = None
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+
+# Online users per room (see core/presence.py): roster changes are coalesced
+# and announced once per flush interval; rosters are re-announced every
+# heartbeat and dropped after three missed heartbeats.
+CHAT_PRESENCE_FLUSH_INTERVAL = 0.5  # seconds
+CHAT_PRESENCE_HEARTBEAT = 30  # seconds
+
+# Typing indicators and read hints (see core/ephemeral.py): sent once per
+# flush interval per room, at most CHAT_EPHEMERAL_RATE per user per second,
+# and a repeated "typing" only every CHAT_TYPING_REFRESH seconds
+CHAT_EPHEMERAL_FLUSH_INTERVAL = 0.25  # seconds
+CHAT_EPHEMERAL_RATE = 5
+CHAT_TYPING_REFRESH = 3  # seconds
+
+# Per-connection outbound queue (see core/outbound.py). When a slow client
+# fills it, ephemeral frames are dropped first, then the policy applies:
+# 'resync' replaces the queue with a resync_required frame, 'disconnect'
+# closes the connection with code 4008.
+CHAT_OUTBOUND_QUEUE_SIZE = 256  # frames
+CHAT_OUTBOUND_QUEUE_BYTES = 1024 * 1024
+CHAT_OUTBOUND_POLICY = 'resync'
+# daphne never backpressures, so the queue above drains at once; the backlog
+# is bounded by the frames clients have not acknowledged yet. Clients must
+# send ack frames unless CHAT_OUTBOUND_REQUIRE_ACKS is off, which leaves it
+# to those connecting with ?ack=1
+CHAT_OUTBOUND_UNACKED_FRAMES = 512
+CHAT_OUTBOUND_UNACKED_BYTES = 4 * 1024 * 1024
+CHAT_OUTBOUND_REQUIRE_ACKS = True
+
+# Token buckets per ChatConsumer frame type (see core/ratelimit.py):
+# scope -> (tokens per second, burst). With CHAT_RATE_LIMIT_SYNC workers share
+# their consumption through the channel layer.
+CHAT_RATE_LIMITS = {
+    'chat_message': {'user': (5, 10), 'room': (50, 100)},
+    'get_messages': {'user': (2, 5)},
+    'sync': {'user': (2, 5)},
+    'replay': {'user': (2, 5)},
 }
+CHAT_RATE_LIMIT_MAX_KEYS = 100000
+CHAT_RATE_LIMIT_SYNC = False
+CHAT_RATE_LIMIT_SYNC_INTERVAL = 0.5  # seconds
+
+# Frame coalescing for connections opened with ?batch=1 (see core/batching.py).
+# Rooms below CHAT_BATCH_MIN_RATE messages/s are never delayed; busier rooms
+# are batched for a window growing from MIN to MAX at CHAT_BATCH_FULL_RATE.
+CHAT_BATCH_MIN_WINDOW = 0.010  # seconds
+CHAT_BATCH_MAX_WINDOW = 0.025  # seconds
+CHAT_BATCH_MIN_RATE = 20
+CHAT_BATCH_FULL_RATE = 200
+CHAT_BATCH_MAX_MESSAGES = 50
+
+# Thread pools for consumer database calls (see core/db.py), and pragmas run
+# on every new SQLite connection
+CHAT_DB_READ_THREADS = 4
+CHAT_DB_WRITE_THREADS = 1
+CHAT_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,  # ms
+}
+
 AUTH_USER_MODEL = 'core.User'
 
 